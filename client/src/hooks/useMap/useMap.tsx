@@ -7,10 +7,10 @@
 
 import { useCallback, useEffect, useMemo, useState } from 'react';
 import { Map } from '../../utils/Map';
-import axios, { AreaOfHighDemandLayerType, ConfigType } from '../../utils/axios';
+import axios, { AreaOfHighDemandLayerType, ConfigType, JobType } from '../../utils/axios';
 import { DataPointType, Nullable, PointType, PolygonType } from '../../utils/types';
 import { MapOptions } from 'leaflet';
-import { inversePoints } from '../../utils/utils';
+import { getGridPolygons, inversePoints } from '../../utils/utils';
 
 /**
  * Fetches configuration data from the server.
@@ -21,14 +21,27 @@ const fetchConfig = async (): Promise<ConfigType>  => {
     return data;
 }
 
+/**
+ * Interval in milliseconds between the checks of the job estimating the areas of high demand.
+ */
+const AREA_POLLING_INTERVAL = 1000;
+
 /**
  * Fetches areas of high demand based on the dataset.
  * @param dataset - The dataset for which to fetch the areas of high demand.
  * @returns A promise resolving to the fetched areas of high demand.
  */
 const fetchAreasOfHighDemandByDataset = async (dataset: string): Promise<AreaOfHighDemandLayerType> => {
-    const { data } = await axios.post<{area: AreaOfHighDemandLayerType}>("/area", { dataset });
-    return data.area;
+    let response = await axios.get<{area: AreaOfHighDemandLayerType} | JobType>("/area", { params: { dataset } });
+
+    // Area that is not estimated yet is estimated by a background job, its result is polled until it is done
+    while (response.status === 202) {
+        const { job } = response.data as JobType;
+        await new Promise(resolve => setTimeout(resolve, AREA_POLLING_INTERVAL));
+        response = await axios.get<{area: AreaOfHighDemandLayerType} | JobType>(`/jobs/${job}/result`);
+    }
+
+    return (response.data as {area: AreaOfHighDemandLayerType}).area;
 }
 
 /**
@@ -55,7 +68,7 @@ const fetchCompetitorsByDataset = async (dataset: string): Promise<DataPointType
  */
 export const initialConfig: ConfigType = {
     center: null,
-    grid: [],
+    grid: null,
     datasets: []
 }
 
@@ -175,9 +188,11 @@ const useMap = () => {
 
                 if(!dataset) return
 
-                const grid = config.grid.map(polygon => inversePoints(polygon) as PolygonType)
+                if(config.grid) {
+                    const grid = getGridPolygons(config.grid).map(polygon => inversePoints(polygon) as PolygonType)
 
-                map.setGridLayer(grid)
+                    map.setGridLayer(grid)
+                }
                 // setDataset(dataset)
     
                 const customers = await fetchCustomers()
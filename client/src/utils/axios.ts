@@ -5,7 +5,7 @@
  */
 
 import axios from "axios";
-import { LocationType, PointType, PolygonType, ScoreMapType } from "./types";
+import { LocationType, PointType, ScoreMapType } from "./types";
 
 /**
  * Represents the result of the Analytic Hierarchy Process (AHP) calculation.
@@ -20,6 +20,16 @@ export type AHPResultType = {
  */
 export type AreaOfHighDemandLayerType = [...PointType, number][]; // Array of points with associated scores
 
+/**
+ * Represents a background job estimating the areas of high demand.
+ */
+export type JobType = {
+    job: string; // Id of the job
+    status: "pending" | "running" | "done" | "failed"; // Status of the job
+    dataset: string; // Name of the dataset
+    error: string | null; // Error message if the job failed
+};
+
 /**
  * Represents a mapping of different layers.
  */
@@ -27,12 +37,25 @@ export type LayersMapType = {
     areaOfHighDemand: AreaOfHighDemandLayerType; // Layer containing points of high demand areas
 };
 
+/**
+ * Represents the description of the grid of squares covering the map area.
+ */
+export type GridType = {
+    west: number; // Longitude of the west edge of the grid
+    south: number; // Latitude of the south edge of the grid
+    columnWidth: number; // Distance between the columns in degrees of longitude
+    height: number; // Height of the squares in degrees of latitude
+    columns: number; // Number of columns
+    rows: number; // Number of rows
+    meters: number; // Size of the squares in meters
+};
+
 /**
  * Represents the configuration settings for the system.
  */
 export type ConfigType = {
     center: PointType | null; // Center point of the map
-    grid: PolygonType[]; // Grid representing the map area
+    grid: GridType | null; // Grid representing the map area
     datasets: string[]; // List of dataset names
 };
 
@@ -4,7 +4,8 @@
  * @author Oleksandr Turytsia
  */
 
-import { PointType } from "./types";
+import { PointType, PolygonType } from "./types";
+import { GridType } from "./axios";
 
 /** Represents the structure of an address object obtained from reverse geocoding. */
 export type AddressType = {
@@ -131,6 +132,29 @@ export const inversePoints = <T extends PointType>(points: T[]): T[] => {
     return points.map(([x, y]) => [y, x] as T);
 };
 
+/**
+ * Builds the squares of the grid from its description.
+ * @param {GridType} grid - Description of the grid.
+ * @returns {PolygonType[]} Squares of the grid column by column, with [longitude, latitude] points.
+ */
+export const getGridPolygons = (grid: GridType): PolygonType[] => {
+    const polygons: PolygonType[] = [];
+
+    for (let column = 0; column < grid.columns; column++) {
+        for (let row = 0; row < grid.rows; row++) {
+            const x1 = grid.west + column * grid.columnWidth;
+            const y1 = grid.south + row * grid.height;
+            // Width of the square in degrees depends on its latitude
+            const x2 = x1 + grid.meters / (Math.cos(y1 * Math.PI / 180) * 111000);
+            const y2 = y1 + grid.height;
+
+            polygons.push([[x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]]);
+        }
+    }
+
+    return polygons;
+};
+
 /**
  * TODO remove it, it doesn't work
  * Reverses key & value in the given object
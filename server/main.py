@@ -1,7 +1,13 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response, Request, Depends
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+import threading
 import os
+import json
+import numpy as np
+from typing import Annotated
 
 from scripts.ahp import (
     ahp_evaluate
@@ -9,27 +15,116 @@ from scripts.ahp import (
 
 from scripts.geocompetition import (
     estimate_geocompetition,
-    get_geocompetition
+    get_geocompetition,
+    get_area_cache,
+    get_area_cache_path,
+    get_area_key
+)
+
+from scripts.surface import (
+    Surface
 )
 
 from settings import (
-    read_config,
+    CONFIG_PATH,
+    CONFIGS,
     CONFIG,
+    ROUTING_GRAPH,
     Config,
+    CompetitorsConfig,
+    Lazy,
     Urls
 )
 
 from utils import (
-    read_dataset,
+    get_dataset,
     get_coordinates,
-    get_squares_list
+    get_grid,
+    get_squares_list,
+    EncodedResponse,
+    JobManager,
+    LRUCache,
+    DATASETS_CACHE
 )
 
 origins = [
     "http://localhost:3000",
 ]
 
-app = FastAPI()
+TEST_CONFIG_PATH = "./tests/init.yaml"
+
+# Grid squares covering the area of the graph
+GRID: Lazy[list[list[float]]] = Lazy(get_squares_list)
+
+# Maximum size of the encoded areas in bytes
+AREA_CACHE_SIZE = 256 * 2**20
+
+# Encoded areas (by media type), by the key of the area (see get_area_key)
+AREA_RESPONSES = LRUCache(AREA_CACHE_SIZE, sizeof=lambda responses: sum(response.nbytes for response in responses.values()))
+
+# Levels of detail of the areas (see Surface.get_levels), by the key of the area
+AREA_LEVELS = LRUCache(AREA_CACHE_SIZE, sizeof=lambda levels: sum(level.nbytes for level in levels if not isinstance(level.density, np.memmap)))
+
+# Encoded tiles of the areas, by the key of the area, level and index of the tile
+AREA_TILES = LRUCache(AREA_CACHE_SIZE, sizeof=len)
+
+# Encoded responses of the viewports, by the key of the area, level and indices of the tiles
+AREA_VIEWPORTS = LRUCache(AREA_CACHE_SIZE, sizeof=lambda response: response.nbytes)
+
+# Maximum number of points of the area sent for one viewport, coarser level of detail is sent if there are more
+AREA_VIEWPORT_POINTS = 10000
+
+# Number of areas estimated at once in the background
+AREA_JOB_WORKERS = 1
+
+# Jobs estimating the areas requested before they were estimated
+AREA_JOBS = JobManager(AREA_JOB_WORKERS)
+
+# Precomputations of the reloaded configurations, one at a time
+RELOAD_JOBS = JobManager(1)
+
+# Keys of the datasets whose areas are cached (already or estimated by the precomputation)
+PRECOMPUTED_DATASETS: list[str] = []
+
+# Errors of the datasets the precomputation failed to estimate, by the key of the dataset
+FAILED_DATASETS: dict[str, str] = {}
+
+# Geocompetition of all the datasets from the configuration is estimated in advance
+PRECOMPUTATION: Lazy[None] = Lazy(lambda: estimate_geocompetition(
+    CONFIG.get(), 
+    on_estimated=PRECOMPUTED_DATASETS.append, 
+    on_failed=FAILED_DATASETS.__setitem__
+))
+
+# State that is loaded in the background once the server starts, in this order
+WARM_UP: dict[str, Lazy] = {
+    "config": CONFIG,
+    "routingGraph": ROUTING_GRAPH,
+    "grid": GRID,
+    "geocompetition": PRECOMPUTATION
+}
+
+def warm_up() -> None:
+    """
+    Load all the heavy state of the server one by one.
+
+    Each step is loaded lazily, so requests that need a step before the warm-up 
+    gets to it load it themselves (and the warm-up reuses it).
+    """
+    for step, lazy in WARM_UP.items():
+        try:
+            lazy.get()
+        except Exception as e:
+            print(f"Warm-up failed on {step}: {e}")
+            return
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Server accepts connections right away, heavy state is loaded in the background
+    threading.Thread(target=warm_up, daemon=True).start()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -40,14 +135,36 @@ app.add_middleware(
 )
 
 def get_config() -> tuple[Config, bool]:
-    
+    """
+    Get the configuration the request should use and whether the application is in test mode.
+
+    The configuration is read only once, it is reread only after the configuration file changes.
+    """
     is_testing = os.getenv("TESTING") == "True"
 
-    config = read_config("./tests/init.yaml") if is_testing else CONFIG
-    estimate_geocompetition(config, is_testing)
+    config = CONFIGS.get(TEST_CONFIG_PATH if is_testing else CONFIG_PATH)
     return config, is_testing
 
-get_config()
+def precompute_config(path: str, is_testing: bool) -> None:
+    # The latest configuration is estimated until it does not change during the estimation
+    config = CONFIGS.get(path)
+    while True:
+        estimate_geocompetition(config, is_testing)
+
+        latest = CONFIGS.get(path)
+        if latest is config:
+            return
+        config = latest
+
+def on_config_reload(path: str, config: Config) -> None:
+    # Datasets added to the changed configuration are estimated in the background
+    # Reloads that come while the precomputation of the file is pending or running are absorbed by it
+    is_testing = path == TEST_CONFIG_PATH
+    RELOAD_JOBS.submit(("precomputation", path), lambda: precompute_config(path, is_testing), config=path)
+
+CONFIGS.add_listener(on_config_reload)
+
+ConfigDependency = Annotated[tuple[Config, bool], Depends(get_config)]
 
 class Location(BaseModel):
     name: str
@@ -60,50 +177,100 @@ class FinalBody(BaseModel):
     locations: list[Location]
     score: dict[str, dict[str, int]]
 
-grid = get_squares_list()
-
 @app.get(Urls.Test.value, tags=["Test"])
-def test():
+def test(settings: ConfigDependency):
     """
     Test endpoint to check if the application is in test mode.
 
     Returns:
     - message: Whether the application is in test mode or not.
     """
-    _, is_testing = get_config()
+    _, is_testing = settings
     return { "message": is_testing }
 
+@app.get(Urls.Ready.value, tags=["Test"])
+def ready(response: Response):
+    """
+    Readiness endpoint reporting the progress of the warm-up.
+
+    Responds with status 503 until all the heavy state is loaded.
+
+    Returns:
+    - ready: Whether all the state is loaded.
+    - steps: Whether each of the warm-up steps is done.
+    - geocompetition: Number of datasets with the cached area (already or estimated by the precomputation), 
+      errors of the datasets the precomputation failed to estimate and the total number of datasets.
+    """
+    steps = {step: lazy.is_ready for step, lazy in WARM_UP.items()}
+    is_ready = all(steps.values())
+
+    if not is_ready:
+        response.status_code = 503
+
+    return {
+        "ready": is_ready,
+        "steps": steps,
+        "geocompetition": {
+            "estimated": len(PRECOMPUTED_DATASETS),
+            "failed": FAILED_DATASETS,
+            "total": len(CONFIG.get().competitors) if CONFIG.is_ready else None
+        }
+    }
+
+@app.get(Urls.Metrics.value, tags=["Test"])
+def metrics():
+    """
+    Get the counters of the caches of the server process.
+
+    Returns:
+    - datasetCache: Entries, size, hits, misses and evictions of the dataset cache.
+    - areaCache: Entries, size, hits, misses and evictions of the cache of encoded areas.
+    - areaTileCache: Entries, size, hits, misses and evictions of the cache of encoded tiles of the areas.
+    - areaViewportCache: Entries, size, hits, misses and evictions of the cache of compressed viewports of the areas.
+    """
+    return {
+        "datasetCache": DATASETS_CACHE.stats(),
+        "areaCache": AREA_RESPONSES.stats(),
+        "areaTileCache": AREA_TILES.stats(),
+        "areaViewportCache": AREA_VIEWPORTS.stats()
+    }
+
 @app.get(Urls.Config.value, tags=["Configuration"])
-async def map():
+async def map(settings: ConfigDependency, polygons: bool = False):
     """
     Get the configuration details including datasets, center coordinates, and grid squares.
 
+    Args:
+    - polygons: Whether to send the grid as the list of squares (query parameter). Defaults to false.
+
     Returns:
     - center: Center coordinates of the area.
     - datasets: List of available datasets.
-    - grid: List of grid squares covering the area.
+    - grid: Description of the grid of squares covering the area (origin, spacing and 
+      number of columns and rows, see Grid.get_description), or the list of grid 
+      squares if polygons is true.
     """
-    config, _ = get_config()
+    config, _ = settings
     return {
         "center": get_coordinates(config.area),
         "datasets": list(config.competitors.keys()),
-        "grid": grid
+        "grid": GRID.get() if polygons else get_grid().get_description()
     }
 
 @app.get(Urls.Customers.value, tags=["Customers"])
-def customers():
+def customers(settings: ConfigDependency):
     """
     Get the customer data.
 
     Returns:
     - customers: List of customer data.
     """
-    config, is_testing = get_config()
-    customers = read_dataset(config.customers, is_testing)
-    return { "customers": customers }
+    config, is_testing = settings
+    customers = get_dataset(config.customers, is_testing)
+    return Response(content=customers.get_response("customers"), media_type="application/json")
 
 @app.post(Urls.Competitors.value, tags=["Competitors"])
-def competitors(body: DatasetRequired):
+def competitors(body: DatasetRequired, settings: ConfigDependency):
     """
     Get the competitor data for a given dataset.
 
@@ -113,32 +280,269 @@ def competitors(body: DatasetRequired):
     Returns:
     - competitors: List of competitor data for the specified dataset.
     """
-    config, is_testing = get_config()
+    config, is_testing = settings
     competitor = config.competitors.get(body.dataset, None)
     if competitor is None:
         return {"competitors": {} }
-    competitors = read_dataset(competitor.path, is_testing)
-    return { "competitors": competitors }
+    competitors = get_dataset(competitor.path, is_testing)
+    return Response(content=competitors.get_response("competitors"), media_type="application/json")
+
+def get_dataset_area_key(competitor: CompetitorsConfig, config: Config, is_testing: bool) -> str:
+    customers = get_dataset(config.customers, is_testing).rows
+    competitors = get_dataset(competitor.path, is_testing).rows
+    return get_area_key(customers, competitors, competitor.distanceDecay, config.density, competitor.meshResolution, competitor.maxTravelTime)
+
+def get_area_responses(dataset: str, config: Config, is_testing: bool) -> dict[str, EncodedResponse] | None:
+    """
+    Get the encoded area of the dataset, estimating it if needed.
+
+    The area is encoded as JSON and as binary float32 array only once. Encoded 
+    responses are kept by the key of the area, which changes together with the
+    datasets or parameters of the estimation, so they never get stale.
+
+    Returns:
+        dict[str, EncodedResponse] | None: Encoded area by the media type, None if the dataset does not exist.
+    """
+    competitor = config.competitors.get(dataset, None)
+    if competitor is None:
+        return None
+
+    key = get_dataset_area_key(competitor, config, is_testing)
+
+    cached = AREA_RESPONSES.get(key)
+    if cached is not None:
+        return cached
+
+    customers = get_dataset(config.customers, is_testing).rows
+    competitors = get_dataset(competitor.path, is_testing).rows
+    area = get_geocompetition(customers, competitors, get_area_cache_path(is_testing), True, competitor.distanceDecay, config.density, competitor.meshResolution, competitor.maxTravelTime).get_rows()
+
+    responses = {
+        "application/json": EncodedResponse(json.dumps({"area": area.tolist()}, allow_nan=False, separators=(",", ":")).encode("utf-8")),
+        "application/octet-stream": EncodedResponse(area.astype("<f4").tobytes(), "application/octet-stream")
+    }
+
+    AREA_RESPONSES.set(key, responses)
+    return responses
+
+def get_area_levels(dataset: str, config: Config, is_testing: bool) -> tuple[str, list[Surface]] | None:
+    """
+    Get the levels of detail of the area of the dataset, estimating the area if needed.
+
+    Returns:
+        tuple[str, list[Surface]] | None: The key of the area and its levels of detail, None if the dataset does not exist.
+    """
+    competitor = config.competitors.get(dataset, None)
+    if competitor is None:
+        return None
+
+    key = get_dataset_area_key(competitor, config, is_testing)
+
+    levels = AREA_LEVELS.get(key)
+    if levels is None:
+        customers = get_dataset(config.customers, is_testing).rows
+        competitors = get_dataset(competitor.path, is_testing).rows
+        levels = get_geocompetition(customers, competitors, get_area_cache_path(is_testing), True, competitor.distanceDecay, config.density, competitor.meshResolution, competitor.maxTravelTime).get_levels()
+        AREA_LEVELS.set(key, levels)
+
+    return key, levels
+
+def get_area_tile(key: str, levels: list[Surface], level: int, x: int, y: int) -> bytes:
+    # Tiles are encoded only once, panning the map sends mostly the tiles that were already encoded
+    tile_key = (key, level, x, y)
+
+    content = AREA_TILES.get(tile_key)
+    if content is None:
+        area = levels[level].get_tile(x, y).get_rows()
+        content = json.dumps({"x": x, "y": y, "area": area.tolist()}, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        AREA_TILES.set(tile_key, content)
+
+    return content
+
+def is_area_ready(key: str, is_testing: bool) -> bool:
+    # Area is ready once it is saved to the cache (or at least encoded, if saving failed)
+    return key in AREA_RESPONSES or key in get_area_cache(get_area_cache_path(is_testing))
+
+def is_area_surface_ready(key: str, is_testing: bool) -> bool:
+    # Tiles are cut from the surface, so it has to be saved to the cache (or its levels at least kept, if saving failed)
+    return key in AREA_LEVELS or key in get_area_cache(get_area_cache_path(is_testing))
+
+def send_encoded(responses: dict[str, EncodedResponse], request: Request) -> Response:
+    media_type = "application/octet-stream" if "application/octet-stream" in request.headers.get("accept", "") else "application/json"
+    media_type = media_type if media_type in responses else "application/json"
+    response = responses[media_type]
+
+    headers = {"ETag": response.etag, "Vary": "Accept, Accept-Encoding", "Cache-Control": "no-cache"}
+
+    if response.matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+
+    encoding, content = response.get_content(request.headers.get("accept-encoding", ""))
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+
+    return Response(content=content, media_type=response.media_type, headers=headers)
+
+def send_area(dataset: str, settings: tuple[Config, bool], request: Request) -> Response | dict:
+    config, is_testing = settings
+    competitor = config.competitors.get(dataset, None)
+
+    if competitor is None:
+        return {"area": {} }
+
+    key = get_dataset_area_key(competitor, config, is_testing)
+    if not is_area_ready(key, is_testing):
+        return send_area_job(dataset, key, config, is_testing)
+
+    responses = get_area_responses(dataset, config, is_testing)
+    return send_encoded(responses, request) # type: ignore
+
+def send_area_job(dataset: str, key: str, config: Config, is_testing: bool, levels: bool = False) -> JSONResponse:
+    # Area that is not estimated yet is estimated in the background, identical requests share the job
+    # Jobs of the tiles keep the levels of detail of the area, jobs of the area keep its encoded responses
+    job = AREA_JOBS.submit(
+        (get_area_cache_path(is_testing), key, levels),
+        (lambda: get_area_levels(dataset, config, is_testing)) if levels else (lambda: get_area_responses(dataset, config, is_testing)),
+        dataset=dataset
+    )
+    return JSONResponse(job.to_dict(), status_code=202, headers={"Location": f"{Urls.Jobs.value}/{job.id}"})
 
 @app.post(Urls.Area.value, tags=["Area"])
-def area(body: DatasetRequired):
+def area(body: DatasetRequired, settings: ConfigDependency, request: Request):
     """
     Get the geographical competition area for a given dataset.
 
+    The area is sent compressed (brotli or gzip, by the Accept-Encoding header) 
+    with an ETag, so unchanged area is not sent again to a client that has it 
+    (If-None-Match header). With "Accept: application/octet-stream" the area is 
+    sent as little-endian float32 array of (latitude, longitude, density) rows.
+
+    If the area is not estimated yet, it is estimated in the background and 
+    the response has status 202 with the job (see the jobs endpoints).
+
     Args:
     - dataset: Name of the dataset.
 
     Returns:
     - area: Geographical competition area for the specified dataset.
     """
-    config, is_testing = get_config()
-    competitor = config.competitors.get(body.dataset, None)
+    return send_area(body.dataset, settings, request)
+
+@app.get(Urls.Area.value, tags=["Area"])
+def get_area(dataset: str, settings: ConfigDependency, request: Request):
+    """
+    Get the geographical competition area for a given dataset (see POST variant), 
+    cacheable by the browsers.
+
+    Args:
+    - dataset: Name of the dataset (query parameter).
+
+    Returns:
+    - area: Geographical competition area for the specified dataset.
+    """
+    return send_area(dataset, settings, request)
+
+@app.get(Urls.AreaTiles.value, tags=["Area"])
+def get_area_tiles(
+    dataset: str,
+    south: float,
+    west: float,
+    north: float,
+    east: float,
+    settings: ConfigDependency,
+    request: Request,
+    maxPoints: int = AREA_VIEWPORT_POINTS
+):
+    """
+    Get the tiles of the geographical competition area within the viewport.
+
+    The area is split into tiles at several levels of detail, level l has every
+    2^l-th point of the area in each dimension. The finest level with at most
+    maxPoints points in the viewport is chosen and only its tiles intersecting 
+    the viewport are sent, so a zoomed in map gets the details of a small part 
+    of the area and a zoomed out map gets a coarse view of all of it. The 
+    response is compressed and has an ETag, the same as the area endpoint.
+
+    If the area is not estimated yet, it is estimated in the background and 
+    the response has status 202 with the job (see the jobs endpoints).
+
+    Args:
+    - dataset: Name of the dataset.
+    - south, west, north, east: Bounds of the viewport.
+    - maxPoints: Maximum number of points in the viewport. Defaults to 10000.
+
+    Returns:
+    - level: The level of detail of the tiles.
+    - tiles: Tiles with their index (x by the longitude, y by the latitude) and the area as (latitude, longitude, density) rows.
+    """
+    config, is_testing = settings
+    competitor = config.competitors.get(dataset, None)
+
     if competitor is None:
-        return {"area": {} }
-    customers = read_dataset(config.customers, is_testing)
-    competitors = read_dataset(competitor.path, is_testing)
-    area = get_geocompetition(customers, competitors, f"./{'tests' if is_testing else 'data'}/{body.dataset}.json", True, competitor.distanceDecay)
-    return {"area": area}
+        return {"level": 0, "tiles": []}
+
+    key = get_dataset_area_key(competitor, config, is_testing)
+    if not is_area_surface_ready(key, is_testing):
+        return send_area_job(dataset, key, config, is_testing, levels=True)
+
+    _, levels = get_area_levels(dataset, config, is_testing) # type: ignore
+
+    # The finest level with at most maxPoints points in the viewport, the coarsest level otherwise
+    level = next(
+        (level for level, surface in enumerate(levels) if len(surface.get_window(south, west, north, east)) <= maxPoints),
+        len(levels) - 1
+    )
+
+    # Viewports with the same tiles share one compressed response, so panning within them compresses nothing again
+    tile_indices = sorted(levels[level].get_tile_indices(south, west, north, east))
+    viewport_key = (key, level, tuple(tile_indices))
+
+    response = AREA_VIEWPORTS.get(viewport_key)
+    if response is None:
+        tiles = [get_area_tile(key, levels, level, x, y) for x, y in tile_indices]
+        response = EncodedResponse(b'{"level":%d,"tiles":[%s]}' % (level, b",".join(tiles)))
+        AREA_VIEWPORTS.set(viewport_key, response)
+
+    return send_encoded({"application/json": response}, request)
+
+@app.get(Urls.Jobs.value + "/{job_id}", tags=["Area"])
+def job_status(job_id: str):
+    """
+    Get the status of the job estimating an area.
+
+    Responds with status 404 if the job does not exist.
+
+    Returns:
+    - job: Id of the job.
+    - status: "pending", "running", "done" or "failed".
+    - dataset: Name of the dataset.
+    - error: Error message if the job failed.
+    - duration: Seconds since the job was submitted (until it finished).
+    """
+    job = AREA_JOBS.get(job_id)
+    if job is None:
+        return JSONResponse({"job": job_id, "status": "unknown"}, status_code=404)
+    return job.to_dict()
+
+@app.get(Urls.Jobs.value + "/{job_id}/result", tags=["Area"])
+def job_result(job_id: str, settings: ConfigDependency, request: Request):
+    """
+    Get the area estimated by the job (the same response as from the area endpoint).
+
+    Responds with the status of the job and status 202 while the job is not finished, 
+    500 if it failed and 404 if it does not exist.
+
+    Returns:
+    - area: Geographical competition area estimated by the job.
+    """
+    job = AREA_JOBS.get(job_id)
+    if job is None:
+        return JSONResponse({"job": job_id, "status": "unknown"}, status_code=404)
+    if job.status == "failed":
+        return JSONResponse(job.to_dict(), status_code=500)
+    if not job.is_finished:
+        return JSONResponse(job.to_dict(), status_code=202)
+    return send_area(job.details["dataset"], settings, request)
 
 @app.post(Urls.Result.value, tags=["Result"])
 def final_locations(body: FinalBody):
@@ -0,0 +1,178 @@
+__author__ = "Oleksandr Turytsia"
+__maintainer__ = "Oleksandr Turytsia"
+__email__ = "xturyt00@stud.fit.vutbr.cz"
+
+import math
+import numpy as np
+from typing import Callable
+from scipy.stats import gaussian_kde
+from scipy.signal import fftconvolve
+from scipy.spatial import cKDTree
+
+# Number of mesh points evaluated at once by the KD-tree backend
+KDTREE_CHUNK_SIZE = 1024
+
+def get_kernel_radius(tolerance: float) -> float:
+    """
+    Get the radius of the kernel (in standard deviations) outside of which it is truncated.
+
+    Outside of the radius, the kernel is smaller than tolerance times its peak value.
+
+    Args:
+        tolerance (float): Relative value of the kernel at the radius.
+
+    Returns:
+        float: The radius of the kernel in standard deviations.
+
+    Example:
+        >>> get_kernel_radius(1e-3)
+        3.7169221888498383
+    """
+    return math.sqrt(-2 * math.log(tolerance))
+
+def get_kernel_deviation(points: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """
+    Get the standard deviation of the kernel in each dimension (the bandwidth chosen by get_density).
+
+    Args:
+        points (np.ndarray): Points of shape (2, N).
+        weights (np.ndarray): Weights of the points of shape (N,).
+
+    Returns:
+        np.ndarray: Standard deviation of the kernel of shape (2,).
+
+    Example:
+        >>> get_kernel_deviation(np.array([[49.19, 49.2, 49.21], [16.6, 16.61, 16.6]]), np.array([1, 2, 1]))
+        array([0.0076 , 0.00537])
+    """
+    return np.sqrt(np.diag(gaussian_kde(points, weights=weights).covariance))
+
+def get_gaussian_density(kde: gaussian_kde, x: np.ndarray, y: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Evaluate the kernel density exactly at every point of the mesh (scipy gaussian_kde).
+
+    Every kernel is evaluated at every point of the mesh, so it costs O(N·M).
+    """
+    grid_x, grid_y = np.meshgrid(x, y, indexing="ij")
+    return kde(np.vstack([grid_x.ravel(), grid_y.ravel()])).reshape(len(x), len(y))
+
+def get_fft_density(kde: gaussian_kde, x: np.ndarray, y: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Evaluate the kernel density using binned FFT convolution.
+
+    The weights of the points are linearly binned onto the evaluated mesh
+    (extended by the radius of the kernel, so points outside of the mesh still
+    contribute to it, and refined if the kernel is narrow compared to the mesh
+    spacing) and the binned weights are convolved with the kernel sampled at 
+    the same spacing.
+    """
+    covariance = kde.covariance
+    deviation = np.sqrt(np.diag(covariance))
+
+    # Half of the tolerance is left for the truncation of the kernel, the other half for the binning
+    radius = get_kernel_radius(tolerance / 2)
+
+    # Error of the linear binning grows with (step / deviation)^2 / 8, mesh is refined to keep it in the tolerance
+    refine = np.maximum(np.ceil(np.array([x[1] - x[0], y[1] - y[0]]) / (deviation * math.sqrt(4 * tolerance))), 1).astype(int)
+    x = np.linspace(x[0], x[-1], (len(x) - 1) * refine[0] + 1)
+    y = np.linspace(y[0], y[-1], (len(y) - 1) * refine[1] + 1)
+    step = np.array([x[1] - x[0], y[1] - y[0]])
+
+    # Number of mesh steps the truncated kernel reaches in each dimension
+    reach = np.ceil(radius * deviation / step).astype(int)
+    shape = (len(x) + 2 * reach[0], len(y) + 2 * reach[1])
+
+    # Linear binning: weight of each point is split among 4 surrounding mesh points
+    position = (kde.dataset - np.array([x[0], y[0]])[:, np.newaxis]) / step[:, np.newaxis] + reach[:, np.newaxis]
+    lower = np.floor(position).astype(int)
+    fraction = position - lower
+
+    inside = np.all((lower >= 0) & (lower < np.array(shape)[:, np.newaxis] - 1), axis=0)
+    lower, fraction, weights = lower[:, inside], fraction[:, inside], kde.weights[inside]
+
+    binned = np.zeros(shape)
+    for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+        weight = weights * (fraction[0] if dx else 1 - fraction[0]) * (fraction[1] if dy else 1 - fraction[1])
+        np.add.at(binned, (lower[0] + dx, lower[1] + dy), weight)
+
+    # Kernel sampled at the mesh spacing, truncated outside of the radius
+    offset_x, offset_y = np.meshgrid(np.arange(-reach[0], reach[0] + 1) * step[0], np.arange(-reach[1], reach[1] + 1) * step[1], indexing="ij")
+    offsets = np.stack([offset_x.ravel(), offset_y.ravel()])
+    distance = np.sum(offsets * np.linalg.solve(covariance, offsets), axis=0).reshape(offset_x.shape)
+    kernel = np.where(distance <= radius ** 2, np.exp(-0.5 * distance), 0) / np.sqrt(np.linalg.det(2 * np.pi * covariance))
+
+    density = np.maximum(fftconvolve(binned, kernel, mode="valid"), 0)
+    return density[::refine[0], ::refine[1]]
+
+def get_kdtree_density(kde: gaussian_kde, x: np.ndarray, y: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Evaluate the kernel density using KD-tree with truncated kernels.
+
+    Points and the mesh are transformed so the kernel becomes a standard normal
+    distribution, then only the pairs of points and mesh points closer than the
+    radius of the kernel are evaluated.
+    """
+    covariance = kde.covariance
+    radius = get_kernel_radius(tolerance / 2)
+
+    # Whitening transformation, after it the Mahalanobis distance is the Euclidean distance
+    whitening = np.linalg.inv(np.linalg.cholesky(covariance))
+
+    grid_x, grid_y = np.meshgrid(x, y, indexing="ij")
+    mesh = (whitening @ np.vstack([grid_x.ravel(), grid_y.ravel()])).T
+    points = (whitening @ kde.dataset).T
+
+    tree = cKDTree(points)
+    density = np.zeros(len(mesh))
+
+    for start in range(0, len(mesh), KDTREE_CHUNK_SIZE):
+        chunk = cKDTree(mesh[start:start + KDTREE_CHUNK_SIZE])
+        pairs = chunk.sparse_distance_matrix(tree, radius, output_type="coo_matrix")
+        kernel = kde.weights[pairs.col] * np.exp(-0.5 * pairs.data ** 2)
+        density[start:start + chunk.n] = np.bincount(pairs.row, weights=kernel, minlength=chunk.n)
+
+    return (density / np.sqrt(np.linalg.det(2 * np.pi * covariance))).reshape(len(x), len(y))
+
+# Available backends of the kernel density estimation, all of them use the bandwidth of gaussian_kde
+DENSITY_BACKENDS: dict[str, Callable[[gaussian_kde, np.ndarray, np.ndarray, float], np.ndarray]] = {
+    "gaussian": get_gaussian_density,
+    "fft": get_fft_density,
+    "kdtree": get_kdtree_density,
+}
+
+def get_density(
+    points: np.ndarray,
+    weights: np.ndarray,
+    x: np.ndarray,
+    y: np.ndarray,
+    backend: str = "gaussian",
+    tolerance: float = 1e-3
+) -> np.ndarray:
+    """
+    Evaluate the weighted kernel density estimation of the points on a regular mesh.
+
+    The bandwidth is chosen by the Scott's rule the same way scipy gaussian_kde
+    does it, the backend only decides how the density is evaluated.
+
+    Args:
+        points (np.ndarray): Points of shape (2, N).
+        weights (np.ndarray): Weights of the points of shape (N,).
+        x (np.ndarray): Evenly spaced coordinates of the mesh in the first dimension.
+        y (np.ndarray): Evenly spaced coordinates of the mesh in the second dimension.
+        backend (str, optional): Name of the backend from DENSITY_BACKENDS. Defaults to "gaussian".
+        tolerance (float, optional): Error of the approximate backends relative to the
+            maximum of the density, it decides where the kernel is truncated and how 
+            fine the binning is. Defaults to 1e-3.
+
+    Returns:
+        np.ndarray: Density of shape (len(x), len(y)), value [i, j] is the density at (x[i], y[j]).
+
+    Raises:
+        KeyError: If the backend does not exist.
+
+    Example:
+        >>> get_density(np.array([[49.19, 49.2], [16.6, 16.61]]), np.array([1, 2]), np.linspace(49.18, 49.21, 3), np.linspace(16.59, 16.62, 3), "fft").shape
+        (3, 3)
+    """
+    kde = gaussian_kde(points, weights=weights)
+    return DENSITY_BACKENDS[backend](kde, x, y, tolerance)
@@ -4,195 +4,200 @@ __author__ = "Oleksandr Turytsia"
 __maintainer__ = "Oleksandr Turytsia"
 __email__ = "xturyt00@stud.fit.vutbr.cz"
 
-import sys
 import os
-import osmnx as ox
-import networkx as nx
 import pandas as pd
-import geopandas as gpd
 import numpy as np
-from shapely.geometry import Point
+import shapely
 import threading
-import json
-from scipy.stats import gaussian_kde
+import hashlib
 import time as tm
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Iterator
 
 from settings import (
-    CONFIG,
-    Config
+    Config,
+    DensityConfig,
+    RoutingConfig
 )
 
 from settings import (
-    GRAPH
+    GRAPH_PATH,
+    ROUTING_CONFIG,
+    ROUTING_GRAPH,
+    Lazy
+)
+
+from scripts.routing import (
+    RoutingGraph,
+    DistanceMatrix
+)
+
+from scripts.graph_store import (
+    get_distance_matrix_path,
+    save_distance_matrix,
+    load_distance_matrix
+)
+
+from scripts.result_cache import (
+    get_result_key,
+    ResultCache
+)
+
+from scripts.surface import (
+    read_surface,
+    write_surface,
+    Surface,
+    SURFACE_EXTENSION
 )
 
 from utils import (
+    get_grid,
     get_squares,
     read_dataset,
+    write_atomically,
+    file_lock,
+    SingleFlight
+)
+
+from scripts.density import (
+    get_density,
+    get_kernel_deviation
 )
 
 AVERAGE_WALKING_SPEED = 6
 
-DEBUG = False
+# Size of the grid squares in meters
+GRID_SIZE = 500
 
-def error(message: str) -> None:
-    """Exits script with error code 1 and error message m
+# Number of points of the mesh the densities are evaluated on in each dimension
+MESH_RESOLUTION = 200
 
-    Args:
-        message (str): Error message
-    """
-    print(f"Error: {message}", file=sys.stderr)
-    exit(1)
-    
-def debug(message: str) -> None:
-    global DEBUG
-    
-    if DEBUG:
-        print(f"{message}")
+# Spacing of the adaptive mesh in standard deviations of the narrowest kernel
+ADAPTIVE_MESH_SPACING = 0.5
 
-def get_geodataframe(data: list[tuple[float, float, float]], key: str) -> gpd.GeoDataFrame:
-    """
-    Converts a list of tuples containing latitude, longitude, and a count into a GeoDataFrame.
+# Minimum and maximum number of points of the adaptive mesh in each dimension
+ADAPTIVE_MESH_BOUNDS = (50, 1000)
 
-    Args:
-        data (list[tuple[float, float, float]]): A list of tuples containing latitude, longitude, and a count.
-        key (str): The key name for the count data.
+# Number of rows of the surface (longitudes of the mesh) the density is evaluated for at once
+SURFACE_TILE_ROWS = 64
 
-    Returns:
-        gpd.GeoDataFrame: A GeoDataFrame containing the input data along with Point geometry.
+# Version of the estimation, cached areas estimated by other versions are not used
+GEOCOMPETITION_VERSION = 3
 
-    Raises:
-        Exception: If an error occurs during the conversion process.
-    """
-    ids, x, y, k = ([], [], [], [])
-    
-    try:
-        
-        for id, (lat, lng, count) in enumerate(data, 1):
-            ids.append(id)
-            x.append(lng)
-            y.append(lat)
-            k.append(count)
-            
-        df = pd.DataFrame({
-            "id": ids,
-            "x": x,
-            "y": y,
-            key: k
-        })
+# Maximum size of the cached areas on the disk in bytes
+AREA_CACHE_QUOTA = 2 * 2**30
+
+DEBUG = False
+
+def debug(message: str) -> None:
+    global DEBUG
     
-        geometry = [Point(x, y) for x, y in zip(df['x'], df['y'])]
-        
-    except Exception as e:
-        error(f"Error occured in get_dataframe: {e}")
-        
-    return gpd.GeoDataFrame(df, geometry=geometry) # type: ignore
+    if DEBUG:
+        print(f"{message}")
 
+# Nearest node of the graph for every grid square (by the size of the squares), aligned with get_squares
+SQUARE_NODES_CACHE: dict[int, np.ndarray] = {}
+SQUARE_NODES_LOCK = threading.Lock()
 
-def fix_float(value):
+def get_square_nodes(meters: int = 500) -> np.ndarray:
     """
-    Fix a floating-point value.
+    Get the nearest node in the graph to the center of every grid square.
 
-    This function rounds the floating-point value to 20 decimal places 
-    if it is not NaN. If the value is NaN, it returns 0.
+    Centers of all the squares are snapped to the graph by one query to the
+    spatial index (KD-tree) of the routing graph. The result is computed only
+    once for every size of the squares and shared by all the datasets.
 
     Args:
-        value (float): The floating-point value to fix.
+        meters (int, optional): The size of the squares in meters. Defaults to 500.
 
     Returns:
-        float: The fixed floating-point value.
-
-    Examples:
-        >>> fix_float(3.14159265358979323846)
-        3.14159265358979323846
+        np.ndarray: Ids of the nearest nodes, value at i is the node of the square i of get_squares.
 
-        >>> fix_float(float('nan'))
-        0.0
+    Example:
+        >>> get_square_nodes()[:3]
+        array([ 26432114, 305961582, 305961582])
     """
-    if pd.isna(value):
-        return 0
+    with SQUARE_NODES_LOCK:
+        if meters not in SQUARE_NODES_CACHE:
+            centers = get_squares(meters)["center"].to_numpy()
+            SQUARE_NODES_CACHE[meters] = ROUTING_GRAPH.get().get_nearest_nodes(shapely.get_x(centers), shapely.get_y(centers))
+
+        return SQUARE_NODES_CACHE[meters]
     
-    return round(value, 20)
+# Distances between the nearest nodes of all the grid squares (by the size of the squares)
+SQUARE_DISTANCES_CACHE: dict[int, DistanceMatrix] = {}
+SQUARE_DISTANCES_LOCK = threading.Lock()
 
-GRAPH_DISTANCE_TO_NODES = {}
-def get_distance_to_node(dest_node: str, current_node: str) -> float | None:
+def get_square_distances(meters: int = 500) -> DistanceMatrix:
     """
-    Calculate the distance between two nodes in a graph.
+    Get the matrix of the distances between the nearest nodes of all the grid squares.
 
-    This function calculates the shortest path distance between the given destination node
-    and the current node in a graph. If the distance is not already stored in the global
-    GRAPH_DISTANCE_TO_NODES dictionary, it calculates the distance using the networkx library
-    and stores it for future use.
+    The matrix is searched only once for every size of the squares and kept
+    in the graph store, so it is shared by all the datasets and by the runs
+    of the server. If the routing config sets matrixMaxTravelTime, only the
+    distances walked within that time are kept (sparse matrix).
 
     Args:
-        dest_node (Any): The destination node.
-        current_node (Any): The current node.
+        meters (int, optional): The size of the squares in meters. Defaults to 500.
 
     Returns:
-        Optional[float]: The distance between the destination node and the current node, 
-        or None if there is no path between them.
-
-    Raises:
-        NetworkXNoPath: If there is no path between the destination node and the current node.
-
-    Notes:
-        This function assumes the existence of a global variable GRAPH_DISTANCE_TO_NODES, 
-        which is a dictionary storing pre-calculated distances between node pairs in the graph.
+        DistanceMatrix: Distances between the nodes of get_square_nodes.
 
     Example:
-        >>> get_distance_to_node('a', 'b')
-        5.0
+        >>> get_square_distances().get_distances(np.array([0]), np.array([0, 1]))
+        array([[  0. , 612.4]])
     """
-    global GRAPH_DISTANCE_TO_NODES
+    with SQUARE_DISTANCES_LOCK:
+        if meters not in SQUARE_DISTANCES_CACHE:
+            limit = get_cutoff_distance(ROUTING_CONFIG.get().matrixMaxTravelTime)
+            path = get_distance_matrix_path(GRAPH_PATH.get(), f"squares-{meters}", limit)
 
-    node_pair = tuple(sorted([dest_node, current_node]))
-            
-    distance = GRAPH_DISTANCE_TO_NODES.get(node_pair)
-    if distance is None:
-        try:
-            distance = nx.shortest_path_length(GRAPH, dest_node, current_node, weight="length")
-            GRAPH_DISTANCE_TO_NODES[node_pair] = distance
-            return distance
-        except nx.exception.NetworkXNoPath:
-            return None
-    return distance
+            # Processes sharing the store search the matrix only once
+            with file_lock(path):
+                try:
+                    matrix = load_distance_matrix(path)
+                except (OSError, ValueError):
+                    routing_graph = ROUTING_GRAPH.get()
+                    matrix = DistanceMatrix.from_routing_graph(routing_graph, routing_graph.get_node_indices(get_square_nodes(meters).tolist()), limit)
+                    save_distance_matrix(matrix, path)
+
+            SQUARE_DISTANCES_CACHE[meters] = matrix
 
-GRAPH_NEAREST_NODES_CACHE = {}
-def get_nearest_node(key: str, x: float, y: float) -> str:
+        return SQUARE_DISTANCES_CACHE[meters]
+
+def get_distances_between_squares(source_nodes: list, target_nodes: list, cutoff: float | None = None, meters: int = 500) -> np.ndarray:
     """
-    Get the nearest node to the given coordinates in the graph.
+    Get the distances from the nearest nodes of some grid squares to the nearest nodes of others.
 
-    This function retrieves the nearest node to the specified coordinates (x, y)
-    in the graph. It first checks if the nearest node for the given key has been
-    cached in the GRAPH_NEAREST_NODES_CACHE. If it has, it returns the cached node.
-    Otherwise, it calculates the nearest node using the osmnx library and caches
-    the result for future use.
+    Distances are looked up in the matrix of the squares (see get_square_distances).
+    If the matrix is sparse and it does not keep every distance up to the cutoff,
+    the distances are searched on the routing graph instead. Both give the exact
+    directed distances, so the result does not depend on the matrix.
 
     Args:
-        key (str): The id identifying the nearest node.
-        x (float): The x-coordinate of the point.
-        y (float): The y-coordinate of the point.
+        source_nodes (list[Any]): Nodes of the source squares.
+        target_nodes (list[Any]): Nodes of the target squares.
+        cutoff (float, optional): Maximum distance. Nodes further away are treated 
+            as unreachable. Defaults to None (no limit).
+        meters (int, optional): The size of the squares in meters. Defaults to 500.
 
     Returns:
-        Any: The nearest node to the given coordinates (its id).
+        np.ndarray: Distances of shape (len(source_nodes), len(target_nodes)). Unreachable nodes are NaN.
+    """
+    matrix = get_square_distances(meters)
+    routing_graph = ROUTING_GRAPH.get()
+    sources, targets = routing_graph.get_node_indices(source_nodes), routing_graph.get_node_indices(target_nodes)
 
-    Notes:
-        This function assumes the existence of a global variable GRAPH_NEAREST_NODES_CACHE,
-        which is a dictionary storing cached nearest nodes for different keys.
+    if matrix.limit is not None and (cutoff is None or cutoff > matrix.limit):
+        distances = routing_graph.get_target_distances(sources, targets, cutoff)
+        return np.where(np.isinf(distances), np.nan, distances)
 
-    Example:
-        >>> get_nearest_node('node_id', 40.7128, -74.0060)
-        'example_node'
-    """
-    global GRAPH_NEAREST_NODES_CACHE
+    distances = matrix.get_distances(sources, targets)
+    if cutoff is not None:
+        distances[distances > cutoff] = np.inf
+    return np.where(np.isinf(distances), np.nan, distances)
 
-    if key in GRAPH_NEAREST_NODES_CACHE:
-        return GRAPH_NEAREST_NODES_CACHE[key]
-    else:
-        nearest_node = ox.distance.nearest_nodes(GRAPH, x, y) # type: ignore
-        GRAPH_NEAREST_NODES_CACHE[key] = nearest_node
-        return nearest_node
-    
 def get_probability(attractiveness: pd.Series, time: pd.Series, distance_decay: float = 1.5) -> pd.Series:
     """
     Calculate the probability based on attractiveness and time.
@@ -223,237 +228,590 @@ def get_probability(attractiveness: pd.Series, time: pd.Series, distance_decay:
     """
     return attractiveness / (time ** distance_decay)
 
-def read_from_cache(path: str) -> pd.DataFrame | None:
-    try:
-        with open(path, "r") as file:
-            return json.loads(file.read())
-    except Exception as e:
-        # print(str(e))
-        return None
-    
-def save_to_cache(data: list[tuple[float, float, float]], path: str) -> None:
-    try:
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w') as json_file:
-            json.dump(data, json_file)
-    except OSError as e:
-        print(str(e))
+def get_huff_probabilities(
+    attractiveness: np.ndarray,
+    time: np.ndarray,
+    entries: np.ndarray,
+    distance_decay: float = 1.5
+) -> np.ndarray:
+    """
+    Calculate the probabilities of the Huff model for all competitors and customer grids at once.
+
+    For each competitor, the probability of customers from a grid going to the competitor
+    is get_probability of the grid divided by the sum of get_probability over all the 
+    customer entries, so each grid counts as many times as many customer entries it has.
+
+    Args:
+        attractiveness (np.ndarray): Attractiveness of each competitor, shape (competitors,).
+        time (np.ndarray): Travel time from each competitor to each customer grid, 
+            shape (competitors, grids). NaN marks grids with no path to the competitor.
+        entries (np.ndarray): Number of customer entries within each grid, shape (grids,).
+        distance_decay (float, optional): The distance decay. Defaults to 1.5.
+
+    Returns:
+        np.ndarray: Probabilities of shape (competitors, grids). Grids with no path to 
+            the competitor have probability 0.
+
+    Example:
+        >>> get_huff_probabilities(np.array([10]), np.array([[5, 10, np.nan]]), np.array([1, 2, 1]), 1)
+        array([[0.5 , 0.25, 0.  ]])
+    """
+    utility = np.nan_to_num(get_probability(attractiveness[:, np.newaxis], time, distance_decay), nan=0.0) # type: ignore
+    utility_sum = (utility * entries).sum(axis=1, keepdims=True)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.nan_to_num(utility / utility_sum, nan=0.0)
+
+def get_cutoff_distance(max_travel_time: float | None) -> float | None:
+    """
+    Get the distance in meters walked at AVERAGE_WALKING_SPEED (km/h) in the travel time in minutes.
+
+    Example:
+        >>> get_cutoff_distance(15)
+        1500.0
+    """
+    return None if max_travel_time is None else max_travel_time * AVERAGE_WALKING_SPEED * 1000 / 60
+
+def get_lost_probability(
+    attractiveness: np.ndarray,
+    time: np.ndarray,
+    entries: np.ndarray,
+    distance_decay: float,
+    max_time: float
+) -> np.ndarray:
+    """
+    Get the upper bound of the probability each competitor loses by the travel time cutoff.
+
+    Customer grids further than the cutoff are not routed to, so their travel
+    time is unknown (NaN) and get_huff_probabilities leaves them out. Their 
+    travel time is more than max_time though, so each of them would have at 
+    most attractiveness / max_time ** distance_decay of the utility of the competitor.
+
+    Args:
+        attractiveness (np.ndarray): Attractiveness of each competitor, shape (competitors,).
+        time (np.ndarray): Travel time from each competitor to each customer grid (NaN beyond the cutoff),
+            shape (competitors, grids), in the units of get_huff_probabilities.
+        entries (np.ndarray): Number of customer entries within each grid, shape (grids,).
+        distance_decay (float): The distance decay.
+        max_time (float): Travel time of the cutoff, in the units of time.
+
+    Returns:
+        np.ndarray: Share of the utility of each competitor that may be lost, shape (competitors,).
+
+    Example:
+        >>> get_lost_probability(np.array([10]), np.array([[5, 10, np.nan]]), np.array([1, 2, 1]), 1, 20)
+        array([0.11111111])
+    """
+    utility = np.nan_to_num(get_probability(attractiveness[:, np.newaxis], time, distance_decay), nan=0.0) # type: ignore
+    reachable = (utility * entries).sum(axis=1)
+    lost = attractiveness * (np.isnan(time) * entries).sum(axis=1) / max_time ** distance_decay
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.nan_to_num(lost / (reachable + lost), nan=0.0)
+
+def get_mesh(customers: np.ndarray, resolution: int = MESH_RESOLUTION) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get the mesh the densities are evaluated on.
+
+    The mesh evenly covers the bounding box of the customers.
+
+    Args:
+        customers (np.ndarray): Customers of shape (N, 3) with latitude, longitude and count.
+        resolution (int, optional): Number of mesh points in each dimension. Defaults to 200.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Latitudes and longitudes of the mesh.
+    """
+    return (
+        np.linspace(min(customers[:, 0]), max(customers[:, 0]), resolution),
+        np.linspace(min(customers[:, 1]), max(customers[:, 1]), resolution)
+    )
+
+def get_mesh_resolution(customers: np.ndarray, deviations: list[np.ndarray], mesh_resolution: int | str = MESH_RESOLUTION) -> int:
+    """
+    Get the number of points of the mesh in each dimension.
+
+    In the adaptive mode the spacing of the mesh is ADAPTIVE_MESH_SPACING times
+    the standard deviation of the narrowest kernel (in the dimension that needs 
+    more points), so a small area or wide kernels get a coarse mesh and a large 
+    area or narrow kernels a fine one, within ADAPTIVE_MESH_BOUNDS.
+
+    Args:
+        customers (np.ndarray): Customers of shape (N, 3), the mesh covers their bounding box.
+        deviations (list[np.ndarray]): Standard deviations of the kernels (see get_kernel_deviation).
+        mesh_resolution (int | str, optional): Number of points, or "adaptive". Defaults to 200.
+
+    Returns:
+        int: The number of points of the mesh in each dimension.
+
+    Example:
+        >>> get_mesh_resolution(np.array([[49.1, 16.5, 1], [49.4, 16.8, 1]]), [np.array([0.01, 0.015])], "adaptive")
+        61
+    """
+    if mesh_resolution != "adaptive":
+        return int(mesh_resolution)
+
+    extent = np.ptp(customers[:, :2], axis=0)
+    deviation = np.min(deviations, axis=0)
+    resolution = np.max(np.ceil(extent / (deviation * ADAPTIVE_MESH_SPACING))) + 1
+
+    return int(np.clip(np.nan_to_num(resolution, nan=MESH_RESOLUTION), *ADAPTIVE_MESH_BOUNDS))
+
+DENSITY_CACHE_PATH = "./data/density"
+
+CUSTOMER_DENSITY_CACHE: dict[str, np.ndarray] = {}
+CUSTOMER_DENSITY_LOCK = threading.Lock()
+def get_customer_density(customers: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray, density: DensityConfig) -> np.ndarray:
+    """
+    Get the kernel density of the customers on the mesh.
+
+    The density of the customers is the same for all competitor datasets, so it is
+    computed only once for each customer dataset, mesh and density configuration.
+    It is kept in the global CUSTOMER_DENSITY_CACHE dictionary and saved to 
+    DENSITY_CACHE_PATH, so it is reused after a restart as well.
+
+    Args:
+        customers (np.ndarray): Customers of shape (N, 3) with latitude, longitude and count.
+        latitudes (np.ndarray): Latitudes of the mesh.
+        longitudes (np.ndarray): Longitudes of the mesh.
+        density (DensityConfig): Backend and tolerance of the kernel density estimation.
+
+    Returns:
+        np.ndarray: Density of shape (len(latitudes), len(longitudes)).
+    """
+    global CUSTOMER_DENSITY_CACHE
+
+    # Mesh is fully defined by its bounds (taken from customers) and number of points
+    key = hashlib.sha1(
+        np.ascontiguousarray(customers, dtype=np.float64).tobytes() + 
+        f"{len(latitudes)}x{len(longitudes)}-{density.backend}-{density.tolerance}".encode()
+    ).hexdigest()
+
+    # Datasets estimated at the same time wait for the first one to compute the density
+    with CUSTOMER_DENSITY_LOCK:
+        if key in CUSTOMER_DENSITY_CACHE:
+            return CUSTOMER_DENSITY_CACHE[key]
+
+        path = os.path.join(DENSITY_CACHE_PATH, f"customers-{key}.npy")
+        try:
+            people_density = np.load(path)
+        except (OSError, ValueError):
+            people_density = get_density(customers[:, :2].T, customers[:, 2], latitudes, longitudes, density.backend, density.tolerance)
+            try:
+                write_atomically(path, lambda file: np.save(file, people_density))
+            except OSError as e:
+                print(str(e))
+
+        CUSTOMER_DENSITY_CACHE[key] = people_density
+        return people_density
+
+# Estimations of the areas that are running, identical estimations wait for the running one instead
+GEOCOMPETITION_CALLS = SingleFlight()
+
+def get_input_hash(*arrays: np.ndarray) -> str:
+    """
+    Get the hash of the content of the arrays.
+
+    Example:
+        >>> get_input_hash(np.array([[49.2, 16.6, 4.0]]))
+        '55b12c2017cc340467f8bf43c6b515fa370023c9'
+    """
+    input_hash = hashlib.sha1()
+    for array in arrays:
+        input_hash.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return input_hash.hexdigest()
+
+def get_graph_fingerprint(routing_graph: RoutingGraph) -> str:
+    """
+    Get the hash of the nodes and the lengths of the edges of the routing graph.
+
+    The arrays are memory-mapped, so hashing them reads each of them only once.
+    """
+    graph_hash = hashlib.sha1()
+    for array in (routing_graph.nodes, routing_graph.indptr, routing_graph.indices, routing_graph.lengths):
+        graph_hash.update(memoryview(np.ascontiguousarray(array)).cast("B"))
+    return graph_hash.hexdigest()
+
+# Hash of the stored routing graph, areas estimated on another graph (or another download of it) are not used
+GRAPH_FINGERPRINT: Lazy[str] = Lazy(lambda: get_graph_fingerprint(ROUTING_GRAPH.get()))
+
+def get_area_cache_path(is_testing: bool = False) -> str:
+    """
+    Get the folder of the cache of the areas.
+    """
+    return f"./{'tests' if is_testing else 'data'}/areas"
+
+def get_area_cache(cache_path: str) -> ResultCache:
+    """
+    Get the cache of the areas in the folder, areas are stored as surface files.
+    """
+    return ResultCache(cache_path, AREA_CACHE_QUOTA, SURFACE_EXTENSION)
+
+def get_area_parameters(
+    customers: np.ndarray,
+    competitors: np.ndarray,
+    distance_decay: float = 1.5,
+    density: DensityConfig = DensityConfig(),
+    mesh_resolution: int | str = MESH_RESOLUTION,
+    max_travel_time: float | None = None
+) -> dict:
+    """
+    Get everything the estimated area depends on.
+
+    The road graph is identified by its folder in the graph store (the area and
+    the type of the network) and by the hash of its content. Distances are exact
+    directed distances whatever the routing config is, so it is not a part of it.
+
+    Returns:
+        dict: Hash of the datasets and parameters of the estimation.
+    """
+    return {
+        "input": get_input_hash(customers, competitors),
+        "graph": {"path": GRAPH_PATH.get(), "fingerprint": GRAPH_FINGERPRINT.get()},
+        "distanceDecay": distance_decay,
+        "walkingSpeed": AVERAGE_WALKING_SPEED,
+        "gridSize": GRID_SIZE,
+        "meshResolution": mesh_resolution,
+        "maxTravelTime": max_travel_time,
+        "density": density.model_dump(),
+        "version": GEOCOMPETITION_VERSION
+    }
+
+def get_area_key(
+    customers: np.ndarray,
+    competitors: np.ndarray,
+    distance_decay: float = 1.5,
+    density: DensityConfig = DensityConfig(),
+    mesh_resolution: int | str = MESH_RESOLUTION,
+    max_travel_time: float | None = None
+) -> str:
+    """
+    Get the key of the area in the cache (see ResultCache).
+
+    Example:
+        >>> get_area_key(customers, competitors, 1.5)
+        '3f1a0c9d...'
+    """
+    customers = np.asarray(customers, dtype=float).reshape(-1, 3)
+    competitors = np.asarray(competitors, dtype=float).reshape(-1, 3)
+    return get_result_key(get_area_parameters(customers, competitors, distance_decay, density, mesh_resolution, max_travel_time))
 
 def get_geocompetition(
     customers: list[tuple[float, float, float]], 
     competitors: list[tuple[float, float, float]], 
     cache_path: str | None,
     use_cache: bool = True,
-    distance_decay: float = 1.5
-) -> list[tuple[float, float, float]]:
-    
-    global tm
+    distance_decay: float = 1.5,
+    density: DensityConfig = DensityConfig(),
+    mesh_resolution: int | str = MESH_RESOLUTION,
+    max_travel_time: float | None = None
+) -> Surface:
+    """
+    Get the geocompetition area of the competitors, estimating it if it is not cached.
+
+    Areas are cached by the hash of the datasets and of all the parameters of 
+    the estimation (see get_area_parameters), so an area is estimated again 
+    whenever anything it depends on changes. Cached areas are surface files
+    (see write_surface), which are written tile by tile while the area is 
+    estimated and memory-mapped when they are read.
+
+    Identical estimations (the same datasets and parameters) that run at the same 
+    time are coalesced, only one of them is estimated and the others wait for it. 
+    Processes estimating the same area wait for each other as well, so the area 
+    is estimated only once and the others read it from the cache.
+
+    Args:
+        customers (list[tuple[float, float, float]]): Customers as (latitude, longitude, count) rows.
+        competitors (list[tuple[float, float, float]]): Competitors as (latitude, longitude, area) rows.
+        cache_path (str | None): The folder of the cache (see get_area_cache_path), None to not cache the area.
+        use_cache (bool, optional): Whether to read the cached area. Defaults to True.
+        distance_decay (float, optional): Distance decay of the Huff model. Defaults to 1.5.
+        density (DensityConfig, optional): Configuration of the kernel density estimation.
+        mesh_resolution (int | str, optional): Number of points of the mesh in each dimension, 
+            or "adaptive" (see get_mesh_resolution). Defaults to 200.
+        max_travel_time (float | None, optional): Maximum travel time to the competitors in minutes,
+            customers further away are not routed to (see get_lost_probability). Defaults to None (no limit).
+
+    Returns:
+        Surface: Density of the competition, get_rows gives it as (latitude, longitude, density) rows.
+    """
+    # Convert datasets into arrays of (latitude, longitude, area or count)
+    competitors = np.asarray(competitors, dtype=float).reshape(-1, 3)
+    customers = np.asarray(customers, dtype=float).reshape(-1, 3)
+
+    parameters = get_area_parameters(customers, competitors, distance_decay, density, mesh_resolution, max_travel_time)
+    key = get_result_key(parameters)
+    cache = get_area_cache(cache_path) if cache_path else None
 
     debug("Checking if data was already evaluated...")
     
     # Use cached results if they exist
-    if cache_path and use_cache:
-        cached_data = read_from_cache(cache_path)
-
-        if cached_data is not None:
-            return cached_data
+    if cache is not None and use_cache:
+        cached_surface = cache.read(key, read_surface)
+
+        if cached_surface is not None:
+            return cached_surface
+
+    def estimate_cached() -> Surface:
+        if cache is None:
+            return estimate_area(customers, competitors, distance_decay, density, mesh_resolution, max_travel_time)
+
+        with cache.lock(key):
+            # Another process could have estimated the area while this one was waiting for the lock
+            cached_surface = cache.read(key, read_surface) if use_cache else None
+            if cached_surface is not None:
+                return cached_surface
+
+            # Tiles of the surface are written as soon as they are estimated
+            # Effect of the travel time cutoff is kept in the manifest together with the parameters
+            report = {}
+            latitudes, longitudes, tiles = estimate_area_tiles(customers, competitors, distance_decay, density, mesh_resolution, max_travel_time, report)
+            try:
+                cache.write(key, lambda surface_file: write_surface(surface_file, latitudes, longitudes, tiles), parameters, "wb", report)
+                return read_surface(cache.get_path(key))
+            except (OSError, ValueError) as e:
+                print(str(e))
+                return estimate_area(customers, competitors, distance_decay, density, mesh_resolution, max_travel_time)
+
+    return GEOCOMPETITION_CALLS.do((cache_path, use_cache, key), estimate_cached)
+
+def estimate_area(
+    customers: np.ndarray,
+    competitors: np.ndarray,
+    distance_decay: float = 1.5,
+    density: DensityConfig = DensityConfig(),
+    mesh_resolution: int | str = MESH_RESOLUTION,
+    max_travel_time: float | None = None
+) -> Surface:
+    """
+    Estimate the geocompetition area (see get_geocompetition) in the memory, without any caching.
+    """
+    latitudes, longitudes, tiles = estimate_area_tiles(customers, competitors, distance_decay, density, mesh_resolution, max_travel_time)
+    return Surface(latitudes, longitudes, np.concatenate(list(tiles)))
+
+def estimate_area_tiles(
+    customers: np.ndarray,
+    competitors: np.ndarray,
+    distance_decay: float = 1.5,
+    density: DensityConfig = DensityConfig(),
+    mesh_resolution: int | str = MESH_RESOLUTION,
+    max_travel_time: float | None = None,
+    report: dict | None = None
+) -> tuple[np.ndarray, np.ndarray, Iterator[np.ndarray]]:
+    """
+    Estimate the geocompetition area tile by tile.
 
-    debug("Creating dataframes...")
+    The probabilities of the Huff model are estimated at once, the density of
+    the probabilities is evaluated lazily for SURFACE_TILE_ROWS longitudes 
+    of the mesh at a time, so only one tile of the surface is held in the memory.
 
-    # Convert datasets into GeoDataFrame
-    gdf_competitors = get_geodataframe(competitors, "area")
-    gdf_customers = get_geodataframe(customers, "count")
+    Args:
+        report (dict, optional): Filled with the effect of the travel time cutoff 
+            ("travelTimeCutoff": share of the pruned pairs and the mean and maximum
+            bound of the lost probability), if there is a cutoff. Defaults to None.
 
-    debug("Generating grid squares...")
+    Returns:
+        tuple[np.ndarray, np.ndarray, Iterator[np.ndarray]]: Latitudes and longitudes of 
+            the mesh and the consecutive rows of the surface (see Surface).
+    """
+    debug("Assigning grid squares...")
         
-    # Generate grid squares from min point to max point
-    gdf_grid = get_squares()
+    # Grid squares from min point to max point
+    grid = get_grid(GRID_SIZE)
     
     # Assign grid to the points from dataset. For example if customer A is inside of grid B, then id of grid B is assigned to customer A
-    gdf_competitors: gpd.GeoDataFrame = gpd.sjoin(gdf_competitors, gdf_grid, how="left", predicate="within")
-    gdf_customers: gpd.GeoDataFrame = gpd.sjoin(gdf_customers, gdf_grid, how="left", predicate="within")
-    
-    # Filter dataframes
-    
-    # Drop rows with NaN values for specified columns
-    gdf_competitors = gdf_competitors.dropna(subset=['center', 'area']) # type: ignore
-    gdf_customers = gdf_customers.dropna(subset=['center', 'count']) # type: ignore
-
-    # Group customers within the same grid and sum them
-    gdf_customers_grouped = gdf_customers.groupby(['index_right']).agg({'count': 'sum'}).reset_index()
-
-    # Concatenate data from grouped competitors and customers with associated grid
-    gdf_customers_grouped = pd.concat([gdf_grid, gdf_customers_grouped.set_index('index_right')], axis=1, join='inner')
-    
-    # Reset index and cast index column to int
-    gdf_customers_grouped.reset_index(inplace=True)
-    gdf_customers_grouped['index'] = gdf_customers_grouped['index'].astype(int)
+    competitor_squares = grid.get_square_indices(competitors[:, 1], competitors[:, 0])
+    customer_squares = grid.get_square_indices(customers[:, 1], customers[:, 0])
+
+    # Drop points outside of the grid and with NaN values
+    competitor_mask = (competitor_squares >= 0) & ~np.isnan(competitors[:, 2])
+    customer_mask = (customer_squares >= 0) & ~np.isnan(customers[:, 2])
+    grid_competitors, competitor_squares = competitors[competitor_mask], competitor_squares[competitor_mask]
+    grid_customers, customer_squares = customers[customer_mask], customer_squares[customer_mask]
     
     debug("Estimating trading areas...")
-    
-    # Stores probabilities of customer going to all the competitors
-    probabilities_list = []
-    
-    for competitor_index in gdf_competitors.index:
 
-        competitor = gdf_competitors.loc[competitor_index]
-        
-        # Get grid center where competitor entry is located
-        competitor_center: Point = competitor["center"]
+    # Nearest node in the graph to the center of every grid square
+    square_nodes = get_square_nodes(GRID_SIZE)
 
-        square_key = competitor["index_right"]
-        area = competitor["area"]
+    # Customer grids (sorted) and number of customer entries within each of them
+    customer_grids, customer_entries = np.unique(customer_squares, return_counts=True)
 
-        # Get nearest node in the graph for competitor
-        dest_node = get_nearest_node(square_key, competitor_center.x, competitor_center.y)
-        
-        square_index = []
-        square_travel_time = []
-        for customer_index in gdf_customers_grouped.index:
-            
-            customer = gdf_customers_grouped.loc[customer_index]
-            
-            # Get grid center where customer entry is located
-            customer_center: Point = customer["center"]
-
-            square_key = customer["index"]
-
-            # Get nearest node in the graph for customer
-            current_node = get_nearest_node(square_key, customer_center.x, customer_center.y)
-            
-            # Get distance from competitor node to customer node
-            distance = get_distance_to_node(dest_node, current_node)
-            if distance is None:
-                continue
-            
-            # Estimate linear travel time to walk from competitor to customer node
-            travel_time = distance / AVERAGE_WALKING_SPEED
-            
-            square_index.append(square_key)
-            square_travel_time.append(travel_time)
-            
-        df_travel_time = pd.DataFrame({
-            "index": square_index,
-            "time": square_travel_time
-        })
-        
-        # Add travel time column to the competitor for each customer grid
-        gdf_customers_merged = pd.merge(df_travel_time, gdf_customers, left_on='index', right_on='index_right', how='inner')
-        
-        # Sometimes time = 0 in gdf_competitors_merged. It can happen if customer and competitor are in the same grid
-        gdf_customers_merged.loc[gdf_customers_merged["time"] == 0, "time"] = 1
-
-        probabilities_sum = get_probability(area, gdf_customers_merged["time"], distance_decay).sum()
-
-        # List with probabilities of all customers going to the current competitor
-        probabilities = []
-        for customer_index in gdf_customers_merged.index:
-            
-            customer = gdf_customers_merged.loc[customer_index]
-            
-            time = customer["time"]
-            
-            probability = (get_probability(area, time, distance_decay) / probabilities_sum)
-
-            probabilities.append(probability)
-        
-        # List with probabilities of all customers going to all the compatitors
-        probabilities_list.append(np.array(probabilities))
+    # Get nearest node in the graph for every customer grid (grid center where customer entries are located)
+    customer_nodes = square_nodes[customer_grids].tolist()
 
+    # Get nearest node in the graph for every competitor (grid center where competitor entry is located)
+    competitor_nodes = square_nodes[competitor_squares].tolist()
 
-    result = gdf_customers_merged
-        
-    # Sometimes probabilities_list contains differently sized arrays, for this reason we add padding
-    max_length = max(len(arr) for arr in probabilities_list)
+    # Get distances from competitor nodes to every customer node, looked up in the distance matrix of the squares
+    # Customer nodes further than the travel time cutoff are unreachable
+    cutoff = get_cutoff_distance(max_travel_time)
+    unique_nodes = list(dict.fromkeys(competitor_nodes))
+    unique_distances = get_distances_between_squares(unique_nodes, customer_nodes, cutoff, GRID_SIZE)
+    node_index = {node: i for i, node in enumerate(unique_nodes)}
+    distances = unique_distances[[node_index[node] for node in competitor_nodes]]
 
-    # Pad the index of result to match the length of overall_probability
-    padded_index = result.index.union(pd.RangeIndex(max_length))
+    # Estimate linear travel time to walk from competitor to customer node (competitors x customer grids)
+    travel_time = distances / AVERAGE_WALKING_SPEED
 
-    # Reindex result with the padded index
-    result = result.reindex(padded_index)
-    
-    padded_probabilities_list = [np.pad(arr, (0, max_length - len(arr)), mode="constant") for arr in probabilities_list]
-
-    # All the probabilites are averaged. It calculates average probability of the customers of visiting all the competitors
-    overall_probability = np.sum(padded_probabilities_list, axis=0) / len(padded_probabilities_list)
-
-    # Set the index of overall_probability to match the index of result
-    overall_probability_df = pd.DataFrame(overall_probability, index=result.index)
-
-    # Add average probability of visiting all the competitors to the customers
-    result["probability"] = overall_probability_df
-
-    result.drop(columns=["geometry", "index_right", "center"], inplace=True)
-    result = result.dropna()
-    result = result.map(fix_float)
+    # Sometimes time = 0. It can happen if customer and competitor are in the same grid
+    travel_time[travel_time == 0] = 1
 
-    result = np.array([(row['y'], row['x'], row['probability']) for _, row in result.iterrows()])
+    # Probabilities of customers from each grid going to each of the competitors
+    probabilities = get_huff_probabilities(grid_competitors[:, 2], travel_time, customer_entries, distance_decay)
 
-    customers = np.array(customers)
+    if cutoff is not None and len(probabilities):
+        lost = get_lost_probability(grid_competitors[:, 2], travel_time, customer_entries, distance_decay, cutoff / AVERAGE_WALKING_SPEED)
+        debug(f"Travel time cutoff of {max_travel_time} min: {np.isnan(travel_time).mean():.1%} of competitor and customer grid pairs pruned, lost probability at most {lost.mean():.2%} on average ({lost.max():.2%} maximum)")
+        if report is not None:
+            report["travelTimeCutoff"] = {"pruned": float(np.isnan(travel_time).mean()), "lostMean": float(lost.mean()), "lostMax": float(lost.max())}
 
-    people_latitudes = customers[:, 0]
-    people_longitudes = customers[:, 1]
-    people_values = customers[:, 2]
-
-    probability_latitudes = result[:, 0]
-    probability_longitudes = result[:, 1]
-    probability_values = result[:, 2]
+    # All the probabilites are averaged. It calculates average probability of the customers of visiting all the competitors
+    # Grids without any reachable competitor (NaN) have zero probability
+    overall_probability = np.round(np.nan_to_num(probabilities.sum(axis=0) / len(probabilities), nan=0.0, posinf=np.inf, neginf=-np.inf), 20)
+
+    # Add average probability of visiting all the competitors to the customers (by their grid)
+    customer_probability = overall_probability[np.searchsorted(customer_grids, customer_squares)]
+
+    # Generate a grid of points covering the area of interest, fine enough for the narrowest of the kernels in the adaptive mode
+    deviations = [get_kernel_deviation(customers[:, :2].T, customers[:, 2]), get_kernel_deviation(grid_customers[:, :2].T, customer_probability)] if mesh_resolution == "adaptive" else []
+    mesh_latitudes, mesh_longitudes = get_mesh(customers, get_mesh_resolution(customers, deviations, mesh_resolution))
+
+    # Density of the customers is shared by all the datasets, density [i, j] is at (mesh_latitudes[i], mesh_longitudes[j])
+    people_density = get_customer_density(customers, mesh_latitudes, mesh_longitudes, density)
+
+    def get_tiles() -> Iterator[np.ndarray]:
+        # Tiles have at least 2 longitudes, so the spacing of the mesh is known to the density backends
+        for tile in np.array_split(np.arange(len(mesh_longitudes)), max(len(mesh_longitudes) // SURFACE_TILE_ROWS, 1)):
+            longitudes = slice(tile[0], tile[-1] + 1)
+            probability_density = get_density(grid_customers[:, :2].T, customer_probability, mesh_latitudes, mesh_longitudes[longitudes], density.backend, density.tolerance)
+
+            # Combine the density estimates from both datasets (transposed to follow the order of the rows of the surface)
+            yield (people_density[:, longitudes] * probability_density).T
+
+    return mesh_latitudes, mesh_longitudes, get_tiles()
+
+def estimate_dataset(
+    dataset_key: str,
+    path: str,
+    customers_path: str,
+    cache_path: str,
+    distance_decay: float,
+    density: DensityConfig,
+    mesh_resolution: int | str = MESH_RESOLUTION,
+    max_travel_time: float | None = None,
+    graph_path: str | None = None,
+    routing: RoutingConfig | None = None
+) -> tuple[str, float]:
+    """
+    Estimate geocompetition of one competitor dataset and save it to the cache (folder of the cache).
 
-    # Perform kernel density estimation for both datasets
-    people_kde = gaussian_kde(np.vstack([people_latitudes, people_longitudes]), weights=people_values)
-    probability_kde = gaussian_kde(np.vstack([probability_latitudes, probability_longitudes]), weights=probability_values)
+    This function is run by the worker processes of estimate_geocompetition. The
+    graph and the routing settings are taken from the process that started the
+    worker (graph_path and routing), not from the configuration file, so the
+    worker routes on the graph and uses the distance matrix that process stored.
 
-    # Generate a grid of points covering the area of interest
-    grid_lat, grid_lng = np.meshgrid(np.linspace(min(people_latitudes), max(people_latitudes), 200),
-                                    np.linspace(min(people_longitudes), max(people_longitudes), 200))
+    Returns:
+        tuple[str, float]: The key of the dataset and the duration of the estimation in seconds.
+    """
+    if graph_path is not None:
+        GRAPH_PATH.set(graph_path)
+    if routing is not None:
+        ROUTING_CONFIG.set(routing)
 
-    # Combine the density estimates from both datasets
-    combined_density = people_kde(np.vstack([grid_lat.ravel(), grid_lng.ravel()])) * \
-                    probability_kde(np.vstack([grid_lat.ravel(), grid_lng.ravel()]))
+    start_time = tm.time()
+    customers = read_dataset(customers_path)
+    competitors = read_dataset(path)
+    _ = get_geocompetition(customers, competitors, cache_path, True, distance_decay, density, mesh_resolution, max_travel_time)
+    return dataset_key, tm.time() - start_time
 
-    data = list(zip(grid_lat.ravel(), grid_lng.ravel(), combined_density))
-    
-    if cache_path:
-        save_to_cache(data, cache_path)
-    
-    return data
-    
-    
+def get_available_cores() -> int:
+    """
+    Get the number of cores this process may run on (limited by the CPU affinity of a container as well).
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def estimate_geocompetition(
+    config: Config, 
+    is_testing: bool = False, 
+    on_estimated: Callable[[str], None] | None = None,
+    workers: int | None = None,
+    on_failed: Callable[[str, str], None] | None = None
+):
+    """
+    Estimate geocompetition of all competitor datasets missing in the cache.
 
+    Datasets are estimated by a pool of worker processes (one per core available
+    to this process by default), since the estimation is CPU-bound. Workers are 
+    started from a fresh interpreter (forkserver or spawn), since forking the 
+    threads of the server could copy locks they hold into the workers. The graph,
+    the distances between the grid squares and the customer density are stored 
+    on the disk by this process first, so the workers only load them. Workers
+    get the graph path and the routing settings of this process explicitly.
 
-def estimate_geocompetition(config: Config, is_testing: bool = False):
+    Args:
+        config (Config): The configuration with the datasets.
+        is_testing (bool, optional): Whether the datasets are cached for tests. Defaults to False.
+        on_estimated (Callable[[str], None], optional): Called with the key of each 
+            dataset whose area is in the cache, whether it was cached already or it
+            was just estimated. Defaults to None.
+        workers (int, optional): Number of worker processes. Defaults to number of cores.
+        on_failed (Callable[[str, str], None], optional): Called with the key of each 
+            dataset whose estimation failed and the error. Defaults to None.
+    """
+    cache_path = get_area_cache_path(is_testing)
+    cache = get_area_cache(cache_path)
     customers = read_dataset(config.customers)
 
-    def estimate(dataset_key: str, path: str, distance_decay: float = 1.5) -> None:
-        competitors = read_dataset(path)
-        _ = get_geocompetition(customers, competitors, f"./{'tests' if is_testing else 'data'}/{dataset_key}.json", True, distance_decay)
+    # Checking which datasets are missing (areas of changed datasets or parameters are missing as well)
+    missing = {
+        dataset_key: competitor for dataset_key, competitor in config.competitors.items() 
+        if get_area_key(customers, read_dataset(competitor.path), competitor.distanceDecay, config.density, competitor.meshResolution, competitor.maxTravelTime) not in cache
+    }
 
-    should_estimate = False
-    # Checking if any dataset is missing
-    for dataset_key, competitor in config.competitors.items():
-        dataset_path = f"./{'tests' if is_testing else 'data'}/{dataset_key}.json"
-        if not os.path.exists(dataset_path):
-            should_estimate = True
-            break
+    if on_estimated is not None:
+        for dataset_key in config.competitors.keys() - missing.keys():
+            on_estimated(dataset_key)
 
     # If all datasets are present, no estimation needed
-    if not should_estimate:
+    if not missing:
         return
     
     start_time = tm.time()
 
-    threads = []
-    for dataset_key, competitor in config.competitors.items():
-        thread = threading.Thread(target=estimate, args=(dataset_key, competitor.path, competitor.distanceDecay))
-        threads.append(thread)
-        thread.start()
-
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
+    # Shared state is stored before the workers start, so they load it instead of computing it
+    ROUTING_GRAPH.get()
+    get_square_distances(GRID_SIZE)
+    for mesh_resolution in {competitor.meshResolution for competitor in missing.values() if competitor.meshResolution != "adaptive"}:
+        get_customer_density(customers, *get_mesh(customers, mesh_resolution), config.density)
+
+    context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+    workers = min(workers or get_available_cores(), len(missing))
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {
+            executor.submit(
+                estimate_dataset, dataset_key, competitor.path, config.customers, cache_path, competitor.distanceDecay, 
+                config.density, competitor.meshResolution, competitor.maxTravelTime, GRAPH_PATH.get(), ROUTING_CONFIG.get()
+            ): dataset_key
+            for dataset_key, competitor in missing.items()
+        }
+
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                dataset_key, duration = future.result()
+            except Exception as e:
+                print(f"[{done}/{len(futures)}] {futures[future]} failed: {e}")
+                if on_failed is not None:
+                    on_failed(futures[future], str(e))
+                continue
 
-    end_time = tm.time()
+            print(f"[{done}/{len(futures)}] {dataset_key} estimated in {duration:.2f} s")
+            if on_estimated is not None:
+                on_estimated(dataset_key)
 
-    duration = end_time - start_time
+    duration = tm.time() - start_time
 
-    print(f"Get_geocompetition execution time: {duration}\nNumber of threads: {len(threads)}")
\ No newline at end of file
+    print(f"Get_geocompetition execution time: {duration}\nNumber of processes: {workers}")
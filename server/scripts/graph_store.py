@@ -0,0 +1,199 @@
+__author__ = "Oleksandr Turytsia"
+__maintainer__ = "Oleksandr Turytsia"
+__email__ = "xturyt00@stud.fit.vutbr.cz"
+
+import os
+import re
+import shutil
+import pickle
+import numpy as np
+import osmnx as ox
+import networkx as nx
+
+from scripts.routing import (
+    RoutingGraph,
+    DistanceMatrix
+)
+
+GRAPH_STORE_PATH = "./data/graphs"
+
+# Arrays of the routing graph, each of them is stored in its own .npy file
+ROUTING_GRAPH_ARRAYS = ("nodes", "indptr", "indices", "lengths", "x", "y")
+
+# Arrays of the distance matrix, the CSR arrays are stored only for the sparse matrix
+DISTANCE_MATRIX_ARRAYS = ("nodes", "distances", "indptr", "indices")
+
+def get_store_path(area: str, network_type: str = "drive", store_path: str = GRAPH_STORE_PATH) -> str:
+    """
+    Get the path to the stored graph of the area.
+
+    Args:
+        area (str): The name of the area (for example "Brno, Czech Republic").
+        network_type (str, optional): The type of the road network. Defaults to "drive".
+        store_path (str, optional): The folder with all the stored graphs.
+
+    Returns:
+        str: The folder where the graph of the area is stored.
+
+    Example:
+        >>> get_store_path("Brno, Czech Republic")
+        './data/graphs/brno-czech-republic--drive'
+    """
+    area_key = re.sub(r"[^\w]+", "-", area.lower()).strip("-")
+    return os.path.join(store_path, f"{area_key}--{network_type}")
+
+def save_graph(graph: nx.MultiDiGraph, routing_graph: RoutingGraph, path: str) -> None:
+    """
+    Save the graph and its routing representation to the store.
+
+    The networkx graph is pickled and the arrays of the routing graph are saved
+    as .npy files, so they can be memory-mapped when loading. Files are written
+    into a temporary folder first, which is renamed once everything is written,
+    so a partially written graph is never loaded.
+
+    Args:
+        graph (nx.MultiDiGraph): The graph to save.
+        routing_graph (RoutingGraph): Routing representation of the graph.
+        path (str): The folder to save the graph to.
+    """
+    temp_path = f"{path}.tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+
+    for name in ROUTING_GRAPH_ARRAYS:
+        np.save(os.path.join(temp_path, f"{name}.npy"), getattr(routing_graph, name))
+
+    with open(os.path.join(temp_path, "graph.pkl"), "wb") as file:
+        pickle.dump(graph, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temp_path, path)
+
+def load_graph(path: str) -> nx.MultiDiGraph:
+    """
+    Load the networkx graph from the store.
+
+    Args:
+        path (str): The folder the graph is stored in.
+
+    Returns:
+        nx.MultiDiGraph: The stored graph.
+
+    Raises:
+        FileNotFoundError: If the graph is not stored.
+    """
+    with open(os.path.join(path, "graph.pkl"), "rb") as file:
+        return pickle.load(file)
+
+def load_routing_graph(path: str) -> RoutingGraph:
+    """
+    Load the routing graph from the store.
+
+    The arrays are memory-mapped, so only the parts of the graph that are
+    actually used are read from the disk.
+
+    Args:
+        path (str): The folder the graph is stored in.
+
+    Returns:
+        RoutingGraph: The stored routing graph.
+
+    Raises:
+        FileNotFoundError: If the graph is not stored.
+    """
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ROUTING_GRAPH_ARRAYS}
+    return RoutingGraph(**arrays)
+
+def get_graph_path(area: str, network_type: str = "drive", store_path: str = GRAPH_STORE_PATH) -> str:
+    """
+    Get the path to the stored graph of the area, storing the graph first if needed.
+
+    If the graph of the area was not stored yet, it is downloaded using osmnx
+    and saved together with its routing representation. Once the graph is
+    stored, no download is needed, so the server can start offline. If only
+    the routing representation is missing (or incomplete), it is rebuilt 
+    from the stored graph.
+
+    Args:
+        area (str): The name of the area (for example "Brno, Czech Republic").
+        network_type (str, optional): The type of the road network. Defaults to "drive".
+        store_path (str, optional): The folder with all the stored graphs.
+
+    Returns:
+        str: The folder where the graph of the area is stored.
+    """
+    path = get_store_path(area, network_type, store_path)
+
+    if not os.path.exists(os.path.join(path, "graph.pkl")):
+        graph = ox.graph_from_place(area, network_type=network_type)
+        save_graph(graph, RoutingGraph.from_graph(graph), path)
+    elif not all(os.path.exists(os.path.join(path, f"{name}.npy")) for name in ROUTING_GRAPH_ARRAYS):
+        graph = load_graph(path)
+        save_graph(graph, RoutingGraph.from_graph(graph), path)
+
+    return path
+
+def get_distance_matrix_path(path: str, name: str, limit: float | None = None) -> str:
+    """
+    Get the path to the stored distance matrix of the graph.
+
+    Args:
+        path (str): The folder the graph is stored in.
+        name (str): Name of the set of nodes of the matrix (for example "squares-500").
+        limit (float | None, optional): Maximum distance kept by the sparse matrix. Defaults to None (dense matrix).
+
+    Returns:
+        str: The folder where the matrix is stored.
+
+    Example:
+        >>> get_distance_matrix_path("./data/graphs/brno-czech-republic--drive", "squares-500", 5000)
+        './data/graphs/brno-czech-republic--drive/distances/squares-500--5000'
+    """
+    return os.path.join(path, "distances", name if limit is None else f"{name}--{limit:g}")
+
+def save_distance_matrix(matrix: DistanceMatrix, path: str) -> None:
+    """
+    Save the distance matrix to the store.
+
+    The arrays are saved as .npy files and renamed into place once everything
+    is written, the same way the graph is saved.
+
+    Args:
+        matrix (DistanceMatrix): The matrix to save.
+        path (str): The folder to save the matrix to.
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+
+    for name in DISTANCE_MATRIX_ARRAYS:
+        if getattr(matrix, name) is not None:
+            np.save(os.path.join(temp_path, f"{name}.npy"), getattr(matrix, name))
+
+    if matrix.limit is not None:
+        np.save(os.path.join(temp_path, "limit.npy"), np.array(matrix.limit))
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temp_path, path)
+
+def load_distance_matrix(path: str) -> DistanceMatrix:
+    """
+    Load the distance matrix from the store, memory-mapping its arrays.
+
+    Args:
+        path (str): The folder the matrix is stored in.
+
+    Returns:
+        DistanceMatrix: The stored matrix.
+
+    Raises:
+        FileNotFoundError: If the matrix is not stored.
+    """
+    arrays = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") 
+        for name in DISTANCE_MATRIX_ARRAYS 
+        if name in ("nodes", "distances") or os.path.exists(os.path.join(path, f"{name}.npy"))
+    }
+    limit_path = os.path.join(path, "limit.npy")
+    limit = float(np.load(limit_path)) if os.path.exists(limit_path) else None
+    return DistanceMatrix(**arrays, limit=limit)
@@ -0,0 +1,159 @@
+__author__ = "Oleksandr Turytsia"
+__maintainer__ = "Oleksandr Turytsia"
+__email__ = "xturyt00@stud.fit.vutbr.cz"
+
+import os
+import json
+import time
+import hashlib
+from typing import Any, Callable
+
+from utils import (
+    write_atomically,
+    file_lock
+)
+
+def get_result_key(parameters: dict[str, Any]) -> str:
+    """
+    Get the key of the result computed with the given parameters.
+
+    Args:
+        parameters (dict[str, Any]): Everything the result depends on (JSON serializable).
+
+    Returns:
+        str: Hash of the parameters.
+
+    Example:
+        >>> get_result_key({"input": "55b12c20...", "distanceDecay": 1.5})
+        '0c5f9f3e...'
+    """
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """
+    Content-addressed cache of results on the disk.
+
+    Every result is stored in a file named by its key, the hash of everything
+    the result depends on (see get_result_key). Changed parameters give a new
+    key, so a stale result is never read and only the results that depend on
+    the changed parameters are computed again.
+
+    The manifest (manifest.json in the folder of the cache) records the size,
+    the time of the creation and the parameters of every result. Reading a
+    result only touches the modification time of its file, so readers never
+    lock or rewrite the manifest. Once the results exceed the quota, the least
+    recently used ones (by the modification times) are removed.
+
+    Attributes:
+        path (str): The folder of the cache.
+        quota (int): Maximum size of the results in bytes.
+        extension (str): Extension of the files of the results.
+
+    Example:
+        >>> cache = ResultCache("./data/areas", 2**30)
+        >>> key = get_result_key(parameters)
+        >>> cache.read(key, read_area) or cache.write(key, lambda file: save_area(area, file), parameters)
+    """
+
+    def __init__(self, path: str, quota: int, extension: str = ".json"):
+        self.path = path
+        self.quota = quota
+        self.extension = extension
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.path, "manifest.json")
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}{self.extension}")
+
+    def lock(self, key: str):
+        """
+        Hold the lock of the result shared by all the processes, so it is computed only once.
+
+        The lock file is kept even after the result is evicted, since a process 
+        holding (or waiting for) the removed file would not exclude a process 
+        locking a new file at the same path.
+        """
+        return file_lock(self.get_path(key))
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self.get_path(key))
+
+    def read_manifest(self) -> dict[str, dict[str, Any]]:
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def update_manifest(self, update: Callable[[dict[str, dict[str, Any]]], None]) -> None:
+        # Processes sharing the cache update the manifest one by one
+        with file_lock(self.manifest_path):
+            manifest = self.read_manifest()
+            update(manifest)
+            write_atomically(self.manifest_path, lambda file: json.dump(manifest, file, indent=4), "w")
+
+    def read(self, key: str, read: Callable[[str], Any]) -> Any:
+        """
+        Read the result, marking it as recently used.
+
+        Args:
+            key (str): Key of the result.
+            read (Callable[[str], Any]): Function reading the result from the given path.
+
+        Returns:
+            Any: The result, None if it is not cached (or it could not be read).
+        """
+        try:
+            result = read(self.get_path(key))
+        except (OSError, ValueError):
+            return None
+
+        if result is not None:
+            try:
+                os.utime(self.get_path(key))
+            except OSError:
+                pass
+
+        return result
+
+    def get_accessed(self, key: str, entry: dict[str, Any]) -> float:
+        # Time of the last access is the modification time of the file (see read), the manifest has the time of the creation
+        try:
+            return os.path.getmtime(self.get_path(key))
+        except OSError:
+            return entry.get("accessed", 0)
+
+    def write(self, key: str, write: Callable[[Any], None], parameters: dict[str, Any], mode: str = "w", report: dict[str, Any] | None = None) -> None:
+        """
+        Write the result atomically and remove the least recently used results over the quota.
+
+        Args:
+            key (str): Key of the result.
+            write (Callable[[Any], None]): Function writing the result to the given file object.
+            parameters (dict[str, Any]): Parameters the result was computed with.
+            mode (str, optional): Mode the file is opened in. Defaults to "w".
+            report (dict[str, Any], optional): Details of the computation kept in the manifest 
+                with the parameters (JSON serializable). Defaults to None.
+        """
+        path = self.get_path(key)
+        write_atomically(path, write, mode)
+
+        def add(manifest: dict[str, dict[str, Any]]) -> None:
+            now = time.time()
+            manifest[key] = {"size": os.path.getsize(path), "created": now, "accessed": now, "parameters": parameters}
+            if report:
+                manifest[key]["report"] = report
+
+            # Least recently used results are removed first, the written one is kept even if it exceeds the quota alone
+            size = sum(entry["size"] for entry in manifest.values())
+            for old_key in sorted(manifest, key=lambda entry_key: self.get_accessed(entry_key, manifest[entry_key])):
+                if size <= self.quota or old_key == key:
+                    break
+
+                size -= manifest.pop(old_key)["size"]
+                if os.path.exists(self.get_path(old_key)):
+                    os.remove(self.get_path(old_key))
+
+        self.update_manifest(add)
@@ -0,0 +1,303 @@
+__author__ = "Oleksandr Turytsia"
+__maintainer__ = "Oleksandr Turytsia"
+__email__ = "xturyt00@stud.fit.vutbr.cz"
+
+import numpy as np
+import networkx as nx
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+# Number of source nodes searched at once when only the distances to some of the nodes are kept
+DISTANCE_MATRIX_CHUNK_SIZE = 64
+
+class RoutingGraph:
+    """
+    Compact representation of a road graph used for routing.
+
+    Nodes of the graph are mapped to integer indices (position in the sorted
+    array of node ids) and edges are stored as compressed sparse row (CSR)
+    adjacency arrays with float32 edge lengths. Parallel edges are reduced
+    to the shortest one, the same way networkx treats them when searching
+    for the shortest path in a MultiDiGraph. Coordinates of the nodes are
+    kept as well, together with a spatial index to find the nearest nodes.
+
+    Attributes:
+        nodes (np.ndarray): Sorted node ids, index of the id is index of the node.
+        indptr (np.ndarray): CSR row pointers (edges of node i are indptr[i]:indptr[i + 1]).
+        indices (np.ndarray): CSR column indices (target node of each edge).
+        lengths (np.ndarray): Length of each edge in meters.
+        x (np.ndarray): Longitude of each node.
+        y (np.ndarray): Latitude of each node.
+
+    Example:
+        >>> routing_graph = RoutingGraph.from_graph(GRAPH)
+        >>> routing_graph.get_distances(routing_graph.get_node_indices(['a']))
+        array([[   0. , 1405.2, ...]])
+    """
+
+    def __init__(self, nodes: np.ndarray, indptr: np.ndarray, indices: np.ndarray, lengths: np.ndarray, x: np.ndarray, y: np.ndarray):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+        self.lengths = lengths
+        self.x = x
+        self.y = y
+        self.csgraph = csr_matrix((lengths, indices, indptr), shape=(len(nodes), len(nodes)))
+        self._tree: cKDTree | None = None
+
+    @classmethod
+    def from_graph(cls, graph: nx.MultiDiGraph) -> "RoutingGraph":
+        """
+        Build the routing representation out of the networkx graph.
+
+        Args:
+            graph (nx.MultiDiGraph): The graph (for example from osmnx) with
+                "length" attribute on its edges.
+
+        Returns:
+            RoutingGraph: Routing representation of the graph.
+        """
+        nodes = np.sort(np.fromiter(graph.nodes, dtype=np.int64, count=graph.number_of_nodes()))
+
+        edges = list(graph.edges(data="length", default=1))
+        sources = np.searchsorted(nodes, np.fromiter((u for u, _, _ in edges), dtype=np.int64, count=len(edges)))
+        targets = np.searchsorted(nodes, np.fromiter((v for _, v, _ in edges), dtype=np.int64, count=len(edges)))
+        lengths = np.fromiter((length for _, _, length in edges), dtype=np.float64, count=len(edges))
+
+        # Sort edges by source, target and length, so the shortest of the parallel edges goes first
+        order = np.lexsort((lengths, targets, sources))
+        sources, targets, lengths = sources[order], targets[order], lengths[order]
+
+        # Keep only the shortest of the parallel edges
+        first = np.ones(len(sources), dtype=bool)
+        first[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+        sources, targets, lengths = sources[first], targets[first], lengths[first]
+
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=len(nodes)), out=indptr[1:])
+
+        x = np.array([graph.nodes[node]["x"] for node in nodes], dtype=np.float64)
+        y = np.array([graph.nodes[node]["y"] for node in nodes], dtype=np.float64)
+
+        return cls(nodes, indptr, targets.astype(np.int32), lengths.astype(np.float32), x, y)
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes used by the arrays of the graph."""
+        return self.nodes.nbytes + self.indptr.nbytes + self.indices.nbytes + self.lengths.nbytes + self.x.nbytes + self.y.nbytes
+
+    @staticmethod
+    def get_unit_vectors(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Convert longitudes and latitudes to points on the unit sphere.
+
+        Euclidean distance between the points grows with the great-circle distance,
+        so the nearest point on the sphere is the nearest point on the Earth.
+        """
+        longitude, latitude = np.radians(x), np.radians(y)
+        return np.column_stack([np.cos(latitude) * np.cos(longitude), np.cos(latitude) * np.sin(longitude), np.sin(latitude)])
+
+    def get_nearest_nodes(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Get the nearest nodes to the given coordinates.
+
+        The spatial index (KD-tree) over the nodes is built on the first call and 
+        reused afterwards, all the coordinates are snapped by one vectorized query.
+
+        Args:
+            x (np.ndarray): Longitudes of the points.
+            y (np.ndarray): Latitudes of the points.
+
+        Returns:
+            np.ndarray: Ids of the nearest nodes, aligned with the points.
+        """
+        if self._tree is None:
+            self._tree = cKDTree(self.get_unit_vectors(self.x, self.y))
+
+        _, indices = self._tree.query(self.get_unit_vectors(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)))
+        return self.nodes[indices]
+
+    def get_node_indices(self, nodes: list) -> np.ndarray:
+        """
+        Get indices of the given node ids.
+
+        Args:
+            nodes (list[Any]): Node ids from the networkx graph.
+
+        Returns:
+            np.ndarray: Indices of the nodes in the routing graph.
+
+        Raises:
+            KeyError: If any of the nodes is not a part of the graph.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        indices = np.searchsorted(self.nodes, nodes)
+
+        if np.any(indices >= len(self.nodes)) or np.any(self.nodes[np.minimum(indices, len(self.nodes) - 1)] != nodes):
+            raise KeyError("Node is not in the graph")
+
+        return indices
+
+    def get_distances(self, sources: np.ndarray, cutoff: float | None = None) -> np.ndarray:
+        """
+        Calculate the shortest path distances from the source nodes to all the nodes.
+
+        Args:
+            sources (np.ndarray): Indices of the source nodes.
+            cutoff (float, optional): Maximum distance to search. Nodes further away
+                are treated as unreachable. Defaults to None (no limit).
+
+        Returns:
+            np.ndarray: Matrix of shape (len(sources), number of nodes) with the
+                distances. Unreachable nodes are inf.
+        """
+        return dijkstra(self.csgraph, indices=sources, limit=np.inf if cutoff is None else cutoff)
+
+    def get_target_distances(self, sources: np.ndarray, targets: np.ndarray, cutoff: float | None = None) -> np.ndarray:
+        """
+        Calculate the shortest path distances from the source nodes to the target nodes.
+
+        Sources are searched by chunks of DISTANCE_MATRIX_CHUNK_SIZE nodes and only
+        the distances to the targets are kept from each chunk, so the distances to
+        all the nodes are never held for all the sources at once.
+
+        Args:
+            sources (np.ndarray): Indices of the source nodes.
+            targets (np.ndarray): Indices of the target nodes.
+            cutoff (float, optional): Maximum distance to search. Defaults to None (no limit).
+
+        Returns:
+            np.ndarray: Matrix of shape (len(sources), len(targets)) with the distances. Unreachable nodes are inf.
+        """
+        distances = np.empty((len(sources), len(targets)))
+        for start in range(0, len(sources), DISTANCE_MATRIX_CHUNK_SIZE):
+            distances[start:start + DISTANCE_MATRIX_CHUNK_SIZE] = self.get_distances(sources[start:start + DISTANCE_MATRIX_CHUNK_SIZE], cutoff)[:, targets]
+        return distances
+
+class DistanceMatrix:
+    """
+    Shortest path distances between all pairs of a set of nodes of the routing graph.
+
+    The distances are searched once and read by array lookups afterwards. The
+    dense matrix keeps all the distances as float32 (inf if unreachable). The
+    sparse matrix keeps only the distances up to the limit, as compressed 
+    sparse row (CSR) arrays, so it stays small for many nodes.
+
+    Attributes:
+        nodes (np.ndarray): Sorted indices of the nodes in the routing graph.
+        distances (np.ndarray): Dense matrix of shape (len(nodes), len(nodes)), 
+            value [i, j] is the distance from nodes[i] to nodes[j]. Data of the CSR arrays if sparse.
+        indptr (np.ndarray | None): CSR row pointers if sparse.
+        indices (np.ndarray | None): CSR column indices (positions in nodes) if sparse.
+        limit (float | None): Maximum distance kept by the sparse matrix in meters, None if dense.
+
+    Example:
+        >>> matrix = DistanceMatrix.from_routing_graph(routing_graph, np.array([0, 5, 7]))
+        >>> matrix.get_distances(np.array([5]), np.array([0, 7]))
+        array([[1405.2,  inf]])
+    """
+
+    def __init__(
+        self,
+        nodes: np.ndarray,
+        distances: np.ndarray,
+        indptr: np.ndarray | None = None,
+        indices: np.ndarray | None = None,
+        limit: float | None = None
+    ):
+        self.nodes = nodes
+        self.distances = distances
+        self.indptr = indptr
+        self.indices = indices
+        self.limit = limit
+
+    @property
+    def is_sparse(self) -> bool:
+        return self.indptr is not None
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes used by the arrays of the matrix."""
+        return sum(array.nbytes for array in (self.nodes, self.distances, self.indptr, self.indices) if array is not None)
+
+    @classmethod
+    def from_routing_graph(cls, routing_graph: RoutingGraph, nodes: np.ndarray, limit: float | None = None) -> "DistanceMatrix":
+        """
+        Search the distances between all pairs of the nodes.
+
+        Args:
+            routing_graph (RoutingGraph): The graph to search.
+            nodes (np.ndarray): Indices of the nodes in the routing graph (duplicates are removed).
+            limit (float | None, optional): Maximum distance to keep in meters, the matrix
+                is sparse if it is given. Defaults to None (dense matrix).
+
+        Returns:
+            DistanceMatrix: Distances between the nodes.
+        """
+        nodes = np.unique(nodes)
+        rows, counts, columns = [], [], []
+
+        # Searches run for a chunk of the nodes at a time, only the distances to the nodes of the matrix are kept
+        # Chunks of the sparse matrix are reduced to their reachable distances right away, so the dense matrix is never held
+        for start in range(0, len(nodes), DISTANCE_MATRIX_CHUNK_SIZE):
+            chunk = routing_graph.get_target_distances(nodes[start:start + DISTANCE_MATRIX_CHUNK_SIZE], nodes, limit).astype(np.float32)
+            if limit is None:
+                rows.append(chunk)
+                continue
+
+            reachable = np.isfinite(chunk)
+            rows.append(chunk[reachable])
+            counts.append(reachable.sum(axis=1))
+            columns.append(np.nonzero(reachable)[1].astype(np.int32))
+
+        if limit is None:
+            return cls(nodes, np.concatenate(rows) if rows else np.empty((0, 0), dtype=np.float32))
+
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(counts) if counts else [], out=indptr[1:])
+        data = np.concatenate(rows) if rows else np.empty(0, dtype=np.float32)
+        indices = np.concatenate(columns) if columns else np.empty(0, dtype=np.int32)
+        return cls(nodes, data, indptr, indices, limit)
+
+    def get_positions(self, nodes: np.ndarray) -> np.ndarray:
+        """
+        Get the positions of the nodes (indices in the routing graph) in the matrix.
+
+        Raises:
+            KeyError: If any of the nodes is not a part of the matrix.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        positions = np.searchsorted(self.nodes, nodes)
+
+        if np.any(positions >= len(self.nodes)) or np.any(self.nodes[np.minimum(positions, len(self.nodes) - 1)] != nodes):
+            raise KeyError("Node is not in the distance matrix")
+
+        return positions
+
+    def get_distances(self, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        """
+        Get the distances from the source nodes to the target nodes.
+
+        Args:
+            sources (np.ndarray): Indices of the source nodes in the routing graph.
+            targets (np.ndarray): Indices of the target nodes in the routing graph.
+
+        Returns:
+            np.ndarray: Distances of shape (len(sources), len(targets)). Unreachable 
+                nodes (and nodes further than the limit of the sparse matrix) are inf.
+        """
+        rows, columns = self.get_positions(sources), self.get_positions(targets)
+
+        if not self.is_sparse:
+            return self.distances[np.ix_(rows, columns)].astype(np.float64)
+
+        distances = np.full((len(rows), len(columns)), np.inf)
+        for i, row in enumerate(rows):
+            # Column indices of every row are sorted, so the targets are found by a binary search
+            row_indices = self.indices[self.indptr[row]:self.indptr[row + 1]] # type: ignore
+            positions = np.minimum(np.searchsorted(row_indices, columns), max(len(row_indices) - 1, 0))
+            found = (row_indices[positions] == columns) if len(row_indices) else np.zeros(len(columns), dtype=bool)
+            distances[i, found] = self.distances[self.indptr[row] + positions[found]] # type: ignore
+
+        return distances
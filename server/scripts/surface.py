@@ -0,0 +1,222 @@
+__author__ = "Oleksandr Turytsia"
+__maintainer__ = "Oleksandr Turytsia"
+__email__ = "xturyt00@stud.fit.vutbr.cz"
+
+import json
+import struct
+import numpy as np
+from typing import Any, BinaryIO, Iterable
+
+# First bytes of every surface file
+SURFACE_MAGIC = b"GEOSURF1"
+
+# Raw data of the surface starts at a multiple of this, so it can be memory-mapped efficiently
+SURFACE_ALIGNMENT = 64
+
+# Extension of the surface files
+SURFACE_EXTENSION = ".surface"
+
+# Number of points of the mesh in each dimension of a tile
+SURFACE_TILE_SIZE = 64
+
+class Surface:
+    """
+    Density surface evaluated on a regular mesh.
+
+    Row j of the density is at the longitude j of the mesh and column i at
+    the latitude i, so the rows of the surface follow the order of the
+    (latitude, longitude, density) rows of the area. Read surfaces are
+    memory-mapped, so only the parts that are actually used are read from
+    the disk.
+
+    Attributes:
+        latitudes (np.ndarray): Evenly spaced latitudes of the mesh.
+        longitudes (np.ndarray): Evenly spaced longitudes of the mesh.
+        density (np.ndarray): Density of shape (len(longitudes), len(latitudes)).
+
+    Example:
+        >>> surface = read_surface("./data/areas/3f1a0c9d....surface")
+        >>> surface.get_window(49.19, 16.58, 49.21, 16.62).get_rows()[:1]
+        array([[49.19032, 16.58014, 0.00012]])
+    """
+
+    def __init__(self, latitudes: np.ndarray, longitudes: np.ndarray, density: np.ndarray):
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.density = density
+
+    def __len__(self) -> int:
+        return len(self.latitudes) * len(self.longitudes)
+
+    @property
+    def nbytes(self) -> int:
+        return self.latitudes.nbytes + self.longitudes.nbytes + self.density.nbytes
+
+    def get_window_slices(self, south: float, west: float, north: float, east: float) -> tuple[slice, slice]:
+        """
+        Get the slices of the latitudes and of the longitudes within the bounding box (bounds included).
+        """
+        latitudes = slice(np.searchsorted(self.latitudes, south, side="left"), np.searchsorted(self.latitudes, north, side="right"))
+        longitudes = slice(np.searchsorted(self.longitudes, west, side="left"), np.searchsorted(self.longitudes, east, side="right"))
+        return latitudes, longitudes
+
+    def get_window(self, south: float, west: float, north: float, east: float) -> "Surface":
+        """
+        Get the part of the surface within the bounding box (bounds included).
+
+        The window is a view of the surface, a memory-mapped surface reads only
+        the rows of the window from the disk once they are used.
+
+        Args:
+            south (float): Minimum latitude of the window.
+            west (float): Minimum longitude of the window.
+            north (float): Maximum latitude of the window.
+            east (float): Maximum longitude of the window.
+
+        Returns:
+            Surface: The surface within the bounding box, empty if they do not intersect.
+        """
+        latitudes, longitudes = self.get_window_slices(south, west, north, east)
+        return Surface(self.latitudes[latitudes], self.longitudes[longitudes], self.density[longitudes, latitudes])
+
+    def get_levels(self, size: int = SURFACE_TILE_SIZE) -> list["Surface"]:
+        """
+        Get the levels of detail of the surface.
+
+        Level l keeps every 2^l-th point of the mesh in each dimension, so every
+        level has a quarter of the points of the previous one. Level 0 is the 
+        surface itself, coarser levels are copied into the memory (all of them 
+        together have at most a third of the points of the surface). The
+        coarsest level fits into one tile.
+
+        Args:
+            size (int, optional): Number of points in each dimension of a tile. Defaults to SURFACE_TILE_SIZE.
+
+        Returns:
+            list[Surface]: Surfaces by the level, from the finest to the coarsest.
+        """
+        levels = [self]
+        while max(levels[-1].density.shape) > size:
+            step = 2 ** len(levels)
+            levels.append(Surface(self.latitudes[::step], self.longitudes[::step], np.ascontiguousarray(self.density[::step, ::step])))
+        return levels
+
+    def get_tile_indices(self, south: float, west: float, north: float, east: float, size: int = SURFACE_TILE_SIZE) -> list[tuple[int, int]]:
+        """
+        Get the tiles of the surface intersecting the bounding box.
+
+        Tile (x, y) has the longitudes x * size to (x + 1) * size and the 
+        latitudes y * size to (y + 1) * size of the mesh.
+
+        Returns:
+            list[tuple[int, int]]: Indices (x, y) of the tiles.
+        """
+        latitudes, longitudes = self.get_window_slices(south, west, north, east)
+        if latitudes.start >= latitudes.stop or longitudes.start >= longitudes.stop:
+            return []
+
+        return [
+            (x, y)
+            for x in range(longitudes.start // size, (longitudes.stop - 1) // size + 1)
+            for y in range(latitudes.start // size, (latitudes.stop - 1) // size + 1)
+        ]
+
+    def get_tile(self, x: int, y: int, size: int = SURFACE_TILE_SIZE) -> "Surface":
+        """
+        Get the tile (x, y) of the surface (see get_tile_indices).
+        """
+        latitudes, longitudes = slice(y * size, (y + 1) * size), slice(x * size, (x + 1) * size)
+        return Surface(self.latitudes[latitudes], self.longitudes[longitudes], self.density[longitudes, latitudes])
+
+    def get_rows(self) -> np.ndarray:
+        """
+        Get the surface as (latitude, longitude, density) rows.
+
+        Returns:
+            np.ndarray: Rows of shape (len(surface), 3).
+        """
+        grid_latitudes, grid_longitudes = np.meshgrid(self.latitudes, self.longitudes)
+        return np.column_stack([grid_latitudes.ravel(), grid_longitudes.ravel(), np.asarray(self.density, dtype=np.float64).ravel()])
+
+    def tolist(self) -> list[list[float]]:
+        return self.get_rows().tolist()
+
+def get_surface_header(latitudes: np.ndarray, longitudes: np.ndarray, dtype: Any = "<f8") -> bytes:
+    """
+    Get the header of the surface file.
+
+    The header is the magic, the length of the JSON description and the JSON
+    description of the mesh and the data itself, padded by spaces to the
+    alignment of the raw data.
+    """
+    description = json.dumps({
+        "shape": [len(longitudes), len(latitudes)],
+        "dtype": np.dtype(dtype).str,
+        "latitudes": [float(latitudes[0]), float(latitudes[-1])],
+        "longitudes": [float(longitudes[0]), float(longitudes[-1])]
+    }).encode("utf-8")
+
+    length = len(SURFACE_MAGIC) + 4 + len(description)
+    description += b" " * (-length % SURFACE_ALIGNMENT)
+    return SURFACE_MAGIC + struct.pack("<I", len(description)) + description
+
+def write_surface(file: BinaryIO, latitudes: np.ndarray, longitudes: np.ndarray, tiles: Iterable[np.ndarray], dtype: Any = "<f8") -> None:
+    """
+    Write the surface to the file, one tile of rows at a time.
+
+    Tiles are written as soon as they are produced, so a surface computed
+    tile by tile is never held in the memory at once.
+
+    Args:
+        file (BinaryIO): File opened for binary writing.
+        latitudes (np.ndarray): Evenly spaced latitudes of the mesh.
+        longitudes (np.ndarray): Evenly spaced longitudes of the mesh.
+        tiles (Iterable[np.ndarray]): Consecutive rows of the density, each of shape (rows, len(latitudes)).
+        dtype (Any, optional): Type the density is stored as. Defaults to little-endian float64.
+
+    Raises:
+        ValueError: If the tiles do not cover the mesh.
+    """
+    file.write(get_surface_header(latitudes, longitudes, dtype))
+
+    rows = 0
+    for tile in tiles:
+        tile = np.ascontiguousarray(tile, dtype=dtype)
+        if tile.ndim != 2 or tile.shape[1] != len(latitudes):
+            raise ValueError(f"Tile of shape {tile.shape} does not match {len(latitudes)} latitudes")
+        file.write(memoryview(tile).cast("B"))
+        rows += len(tile)
+
+    if rows != len(longitudes):
+        raise ValueError(f"Tiles have {rows} rows instead of {len(longitudes)}")
+
+def read_surface(path: str) -> Surface:
+    """
+    Read the surface from the file, memory-mapping its density.
+
+    Args:
+        path (str): Path to the surface file.
+
+    Returns:
+        Surface: The read surface.
+
+    Raises:
+        OSError: If the file can not be read.
+        ValueError: If the file is not a surface file or it is incomplete.
+    """
+    with open(path, "rb") as file:
+        if file.read(len(SURFACE_MAGIC)) != SURFACE_MAGIC:
+            raise ValueError(f"{path} is not a surface file")
+        (length,) = struct.unpack("<I", file.read(4))
+        description = json.loads(file.read(length))
+
+    offset = len(SURFACE_MAGIC) + 4 + length
+    shape, dtype = tuple(description["shape"]), np.dtype(description["dtype"])
+    latitudes = np.linspace(*description["latitudes"], shape[1])
+    longitudes = np.linspace(*description["longitudes"], shape[0])
+
+    if 0 in shape:
+        return Surface(latitudes, longitudes, np.empty(shape, dtype=dtype))
+
+    # Memory-mapping fails for incomplete files as well
+    return Surface(latitudes, longitudes, np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape))
@@ -3,28 +3,59 @@ __maintainer__ = "Oleksandr Turytsia"
 __email__ = "xturyt00@stud.fit.vutbr.cz"
 
 import yaml
-from pydantic import BaseModel
-import osmnx as ox
+from pydantic import BaseModel, Field
 import networkx as nx
+import threading
+import os
 from enum import Enum
-from typing import Union
+from typing import Annotated, Union, Callable, Generic, TypeVar, Literal
+
+from scripts.routing import (
+    RoutingGraph
+)
+
+from scripts.graph_store import (
+    get_graph_path,
+    load_graph,
+    load_routing_graph
+)
+
+T = TypeVar("T")
 
 class Urls(Enum):
     Test = "/test"
+    Ready = "/ready"
+    Metrics = "/metrics"
     Config = "/config"
     Customers = "/customers"
     Competitors = "/competitors"
     Area = "/area"
+    AreaTiles = "/area/tiles"
+    Jobs = "/jobs"
     Result = "/result"
 
 class CompetitorsConfig(BaseModel):
     path: str
     distanceDecay: float = 1.75
+    # Number of points of the density mesh in each dimension, "adaptive" picks it by the extent and the bandwidth
+    meshResolution: Annotated[int, Field(ge=2)] | Literal["adaptive"] = 200
+    # Maximum travel time to the competitors in minutes, customers further away are not routed to (no limit by default)
+    maxTravelTime: Annotated[float, Field(gt=0)] | None = None
+
+class DensityConfig(BaseModel):
+    backend: Literal["gaussian", "fft", "kdtree"] = "gaussian"
+    tolerance: float = 1e-3
+
+class RoutingConfig(BaseModel):
+    # Maximum travel time in minutes kept by the square-to-square distance matrix, the matrix is sparse if set (None for the dense matrix of all the distances)
+    matrixMaxTravelTime: Annotated[float, Field(gt=0)] | None = None
 
 class Config(BaseModel):
     area: str
     customers: str
     competitors: dict[str, CompetitorsConfig]
+    density: DensityConfig = DensityConfig()
+    routing: RoutingConfig = RoutingConfig()
 
 def read_config(path: str = 'init.yaml') -> Config:
     # Read and process your custom YAML file
@@ -35,6 +66,130 @@ def read_config(path: str = 'init.yaml') -> Config:
         exit(1)
     return Config(**config)
 
-CONFIG: Config = read_config()
+class Lazy(Generic[T]):
+    """
+    Value that is created on its first use.
+
+    The value is created by the factory function only once, even if it is
+    requested from multiple threads at the same time. Other threads wait
+    until the value is created.
+
+    Example:
+        >>> CONFIG = Lazy(read_config)
+        >>> CONFIG.is_ready
+        False
+        >>> CONFIG.get().area
+        'Brno, Czech Republic'
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value: T | None = None
+        self._is_ready = False
+
+    @property
+    def is_ready(self) -> bool:
+        """Whether the value was already created."""
+        return self._is_ready
+
+    def get(self) -> T:
+        """
+        Get the value, create it if it does not exist yet.
+
+        Returns:
+            T: The value created by the factory function.
+        """
+        if not self._is_ready:
+            with self._lock:
+                if not self._is_ready:
+                    self._value = self._factory()
+                    self._is_ready = True
+        return self._value # type: ignore
+
+    def set(self, value: T) -> None:
+        """
+        Set the value, so it is not created by the factory function.
+
+        Used by the worker processes to take the value of the process that started them.
+        """
+        with self._lock:
+            self._value = value
+            self._is_ready = True
+
+class ConfigRegistry:
+    """
+    Configurations read from the YAML files.
+
+    Each configuration file is read only once and is reread only when its 
+    modification time changes, so getting the configuration costs a single 
+    stat of the file. Listeners are notified when a configuration that was 
+    already read is reread.
+
+    Example:
+        >>> CONFIGS = ConfigRegistry()
+        >>> CONFIGS.get("init.yaml").area
+        'Brno, Czech Republic'
+    """
+
+    def __init__(self):
+        self._configs: dict[str, tuple[int, Config]] = {}
+        self._listeners: list[Callable[[str, Config], None]] = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener: Callable[[str, Config], None]) -> None:
+        """
+        Add a function that is called with the path and the new configuration 
+        once a configuration file is reread after its change.
+        """
+        self._listeners.append(listener)
+
+    def get(self, path: str) -> Config:
+        """
+        Get the configuration from the file, read it if it changed since the last read.
+
+        Args:
+            path (str): Path to the configuration file.
+
+        Returns:
+            Config: The configuration.
+        """
+        try:
+            modified = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            modified = None
+
+        entry = self._configs.get(path)
+        if entry is not None and entry[0] == modified:
+            return entry[1]
+
+        with self._lock:
+            entry = self._configs.get(path)
+            if entry is not None and entry[0] == modified:
+                return entry[1]
+
+            config = read_config(path)
+            self._configs[path] = (modified, config) # type: ignore
+
+        if entry is not None:
+            for listener in self._listeners:
+                listener(path, config)
+
+        return config
+
+CONFIG_PATH = "./init.yaml"
+
+CONFIGS: ConfigRegistry = ConfigRegistry()
+
+# Configuration the server was started with
+CONFIG: Lazy[Config] = Lazy(lambda: CONFIGS.get(CONFIG_PATH))
+
+# Graph is downloaded only once, after that it is loaded from the graph store
+GRAPH_PATH: Lazy[str] = Lazy(lambda: get_graph_path(CONFIG.get().area, network_type="drive"))
+
+# Routing settings of the configuration the server was started with
+ROUTING_CONFIG: Lazy[RoutingConfig] = Lazy(lambda: CONFIG.get().routing)
+
+GRAPH: Lazy[nx.MultiDiGraph] = Lazy(lambda: load_graph(GRAPH_PATH.get()))
 
-GRAPH: nx.MultiDiGraph = ox.graph_from_place(CONFIG.area, network_type="drive")
+ROUTING_GRAPH: Lazy[RoutingGraph] = Lazy(lambda: load_routing_graph(GRAPH_PATH.get()))
@@ -3,10 +3,17 @@ __maintainer__ = "Oleksandr Turytsia"
 __email__ = "xturyt00@stud.fit.vutbr.cz"
 
 from fastapi.testclient import TestClient
-from main import app
+import main
+from main import app, AREA_RESPONSES
 import json
 import pytest
 import os
+import shutil
+import numpy as np
+import time
+import threading
+import osmnx as ox
+import geopandas as gpd
 
 from pytest import (
     approx
@@ -14,28 +21,81 @@ from pytest import (
 
 from utils import (
     get_coordinates,
+    get_grid,
+    get_squares,
     get_squares_list,
-    read_dataset
+    read_dataset,
+    convert_dataset,
+    get_dataset,
+    JobManager,
+    SingleFlight,
+    LRUCache
 )
 
 from scripts.ahp import (
     ahp_evaluate
 )
 
+from scripts.density import (
+    get_density
+)
+
+from scripts import geocompetition, routing
+
 from scripts.geocompetition import (
-    get_geocompetition
+    estimate_geocompetition,
+    get_geocompetition,
+    get_huff_probabilities,
+    get_probability,
+    get_customer_density,
+    get_square_nodes,
+    get_distances_between_squares,
+    get_area_cache_path,
+    get_area_key,
+    get_mesh_resolution,
+    get_lost_probability,
+    CUSTOMER_DENSITY_CACHE,
+    SQUARE_DISTANCES_CACHE
+)
+
+from scripts.surface import (
+    read_surface,
+    write_surface,
+    Surface
+)
+
+from scripts.routing import (
+    DistanceMatrix
+)
+
+from scripts.graph_store import (
+    save_distance_matrix,
+    load_distance_matrix
+)
+
+from scripts.result_cache import (
+    get_result_key,
+    ResultCache
 )
 
 from settings import (
     read_config,
-    Urls
+    ConfigRegistry,
+    CompetitorsConfig,
+    DensityConfig,
+    Urls,
+    GRAPH,
+    ROUTING_GRAPH,
+    Lazy
 )
 
 from main import (
-    FinalBody
+    FinalBody,
+    AREA_LEVELS,
+    AREA_VIEWPORTS
 )
 
-GEOCOMPETITION_TEST_PATH = "./tests/test.csv"
+GEOCOMPETITION_TEST_PATH = get_area_cache_path(True)
 CONFIG_PATH = "./tests/init.yaml"
 
 config = read_config(CONFIG_PATH)
@@ -64,17 +124,36 @@ def test_get_config(monkeypatch):
         "grid": get_squares_list()
     }
 
-    response = client.get(Urls.Config.value)
+    response = client.get(Urls.Config.value, params={"polygons": True})
     assert response.status_code == 200
     assert response.json() == json.loads(json.dumps(expect))
 
+def test_get_config_compact(monkeypatch):
+    
+    monkeypatch.setenv("TESTING", "True")
+
+    response = client.get(Urls.Config.value)
+    assert response.status_code == 200
+
+    # Squares built from the description of the grid are the same as the listed ones
+    grid = response.json()["grid"]
+    column, row = np.divmod(np.arange(grid["columns"] * grid["rows"]), grid["rows"])
+    west = grid["west"] + column * grid["columnWidth"]
+    south = grid["south"] + row * grid["height"]
+    east = west + grid["meters"] / (np.cos(np.radians(south)) * 111000)
+
+    squares = np.array(get_squares_list())
+
+    assert squares[:, 0, 0] == approx(west) and squares[:, 0, 1] == approx(south)
+    assert squares[:, 2, 0] == approx(east) and squares[:, 2, 1] == approx(south + grid["height"])
+
 def test_get_customers(monkeypatch):
     
     monkeypatch.setenv("TESTING", "True")
     
     customers = read_dataset(config.customers, True)
     
-    expect = { "customers": customers }
+    expect = { "customers": customers.tolist() }
 
     response = client.get(Urls.Customers.value)
     assert response.status_code == 200
@@ -92,7 +171,7 @@ def test_get_competitors(monkeypatch):
 
     competitors = read_dataset(competitor.path, True)
     
-    expect = { "competitors": competitors }
+    expect = { "competitors": competitors.tolist() }
 
     response = client.post(Urls.Competitors.value, json=body)
     assert response.status_code == 200
@@ -112,6 +191,13 @@ def test_get_competitors_error(monkeypatch):
     assert response.status_code == 200
     assert response.json() == json.loads(json.dumps(expect))
 
+def wait_for_area(response):
+    # Area that is not estimated yet is estimated by a background job
+    while response.status_code == 202:
+        time.sleep(0.1)
+        response = client.get(f"{Urls.Jobs.value}/{response.json()['job']}/result")
+    return response
+
 def test_area(monkeypatch):
     
     monkeypatch.setenv("TESTING", "True")
@@ -126,8 +212,8 @@ def test_area(monkeypatch):
     competitors = read_dataset(competitor.path, True)
     
 
-    response = client.post(Urls.Area.value, json=body)
-    expected_area = get_geocompetition(customers, competitors, GEOCOMPETITION_TEST_PATH, False, competitor.distanceDecay) 
+    response = wait_for_area(client.post(Urls.Area.value, json=body))
+    expected_area = get_geocompetition(customers, competitors, GEOCOMPETITION_TEST_PATH, False, competitor.distanceDecay).tolist()
 
     assert response.status_code == 200
     for response_coord, expected_coord in zip(response.json()["area"], expected_area):
@@ -146,16 +232,237 @@ def test_area_cached(monkeypatch):
     customers = read_dataset(config.customers, True)
     competitors = read_dataset(competitor.path, True)
     
-    expect = { "area": get_geocompetition(customers, competitors, GEOCOMPETITION_TEST_PATH, True, competitor.distanceDecay) }
-
-    file_path = os.path.abspath(GEOCOMPETITION_TEST_PATH)
+    expect = { "area": get_geocompetition(customers, competitors, GEOCOMPETITION_TEST_PATH, True, competitor.distanceDecay).tolist() }
 
     response = client.post(Urls.Area.value, json=body)
     assert response.status_code == 200
     assert response.json() == json.loads(json.dumps(expect))
 
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    shutil.rmtree(GEOCOMPETITION_TEST_PATH, ignore_errors=True)
+
+def test_area_encoded(monkeypatch):
+    
+    monkeypatch.setenv("TESTING", "True")
+
+    wait_for_area(client.get(Urls.Area.value, params={"dataset": "test"}))
+
+    response = client.get(Urls.Area.value, params={"dataset": "test"}, headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+
+    area = np.array(response.json()["area"])
+
+    response = client.get(Urls.Area.value, params={"dataset": "test"}, headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+
+    response = client.post(Urls.Area.value, json={"dataset": "test"}, headers={"Accept": "application/octet-stream"})
+    assert response.status_code == 200
+    assert np.frombuffer(response.content, dtype="<f4").reshape(-1, 3) == approx(area.astype(np.float32))
+
+def test_area_job(monkeypatch):
+    
+    monkeypatch.setenv("TESTING", "True")
+
+    shutil.rmtree(GEOCOMPETITION_TEST_PATH, ignore_errors=True)
+    AREA_RESPONSES.clear()
+
+    first = client.post(Urls.Area.value, json={"dataset": "test"})
+    second = client.get(Urls.Area.value, params={"dataset": "test"})
+
+    # Identical request made while the area is estimated shares the job
+    assert first.status_code == 202
+    assert second.status_code == 200 or second.json()["job"] == first.json()["job"]
+
+    response = wait_for_area(first)
+    status = client.get(f"{Urls.Jobs.value}/{first.json()['job']}")
+
+    assert response.status_code == 200
+    assert status.json()["status"] == "done" and status.json()["dataset"] == "test"
+    assert client.get(Urls.Area.value, params={"dataset": "test"}).status_code == 200
+    assert client.get(f"{Urls.Jobs.value}/unknown").status_code == 404
+
+def test_area_tiles(monkeypatch):
+
+    monkeypatch.setenv("TESTING", "True")
+
+    area = np.array(wait_for_area(client.get(Urls.Area.value, params={"dataset": "test"})).json()["area"])
+    south, west = area[:, :2].min(axis=0)
+    north, east = area[:, :2].max(axis=0)
+    viewport = {"dataset": "test", "south": south, "west": west, "north": north, "east": east}
+
+    # All the tiles of the finest level have the whole area
+    response = client.get(Urls.AreaTiles.value, params={**viewport, "maxPoints": len(area)})
+    assert response.status_code == 200 and response.json()["level"] == 0
+    tiles = np.concatenate([tile["area"] for tile in response.json()["tiles"]])
+    assert np.unique(tiles, axis=0) == approx(np.unique(area, axis=0))
+
+    # Coarser level is sent if the viewport has too many points, the coarsest one is a single tile
+    response = client.get(Urls.AreaTiles.value, params={**viewport, "maxPoints": 10000})
+    assert response.json()["level"] == 1 and len(np.concatenate([tile["area"] for tile in response.json()["tiles"]])) == 10000
+
+    response = client.get(Urls.AreaTiles.value, params={**viewport, "maxPoints": 1000})
+    assert response.json()["level"] == 2 and len(response.json()["tiles"]) == 1
+
+    # Viewport with the same tiles gets the compressed response of the previous one
+    hits = AREA_VIEWPORTS.stats()["hits"]
+    panned = client.get(Urls.AreaTiles.value, params={**viewport, "north": north - (north - south) / 10, "maxPoints": 1000})
+    assert panned.headers["etag"] == response.headers["etag"] and AREA_VIEWPORTS.stats()["hits"] == hits + 1
+
+    # Zoomed in viewport gets only the tiles it intersects
+    height, width = (north - south) / 10, (east - west) / 10
+    response = client.get(Urls.AreaTiles.value, params={**viewport, "south": south + 4 * height, "north": south + 5 * height, "west": west + 4 * width, "east": west + 5 * width})
+    assert response.json()["level"] == 0 and 0 < len(response.json()["tiles"]) < 4
+
+    # Area that is only encoded (its surface is not saved) is estimated by a job, not by the request
+    shutil.rmtree(GEOCOMPETITION_TEST_PATH, ignore_errors=True)
+    AREA_LEVELS.clear()
+    response = client.get(Urls.AreaTiles.value, params=viewport)
+    assert response.status_code == 202
+    wait_for_area(response)
+    assert client.get(Urls.AreaTiles.value, params=viewport).status_code == 200
+
+def test_job_manager():
+
+    jobs = JobManager()
+    release = threading.Event()
+
+    job = jobs.submit("key", release.wait, dataset="test")
+
+    assert jobs.submit("key", release.wait) is job
+    assert jobs.get(job.id) is job
+
+    release.set()
+    while not job.is_finished:
+        time.sleep(0.01)
+
+    assert job.status == "done"
+    assert jobs.submit("key", lambda: 1 / 0).id != job.id
+
+def test_single_flight():
+
+    calls = SingleFlight()
+    release = threading.Event()
+    estimated = []
+
+    def estimate():
+        release.wait()
+        estimated.append(True)
+        return len(estimated)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(calls.do("key", estimate))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [1, 1, 1, 1]
+    assert calls.do("key", estimate) == 2
+
+def test_surface(tmp_path):
+
+    latitudes, longitudes = np.linspace(49.1, 49.3, 5), np.linspace(16.5, 16.7, 7)
+    density = np.random.default_rng(0).random((len(longitudes), len(latitudes)))
+    path = str(tmp_path / "area.surface")
+
+    # Surface is written tile by tile and memory-mapped when it is read
+    with open(path, "wb") as file:
+        write_surface(file, latitudes, longitudes, (density[start:start + 3] for start in range(0, len(longitudes), 3)))
+
+    surface = read_surface(path)
+    assert isinstance(surface.density, np.memmap)
+    assert surface.get_rows() == approx(Surface(latitudes, longitudes, density).get_rows())
+
+    window = surface.get_window(49.14, 16.55, 49.26, 16.61)
+    assert window.latitudes == approx(latitudes[1:4]) and window.longitudes == approx(longitudes[2:4])
+    assert np.asarray(window.density) == approx(density[2:4, 1:4])
+
+    # Incomplete surface is not read
+    with open(path, "r+b") as file:
+        file.truncate(os.path.getsize(path) - 8)
+    with pytest.raises(ValueError):
+        read_surface(path)
+
+def test_mesh_resolution():
+
+    customers = read_dataset(config.customers, True)
+    deviation = np.ptp(customers[:, :2], axis=0) / 100
+
+    assert CompetitorsConfig(path="", meshResolution="adaptive").meshResolution == "adaptive"
+    assert get_mesh_resolution(customers, [deviation], 150) == 150
+
+    # Narrower kernels need finer mesh, within the bounds
+    assert get_mesh_resolution(customers, [deviation], "adaptive") == 201
+    assert get_mesh_resolution(customers, [deviation, deviation / 2], "adaptive") == 401
+    assert get_mesh_resolution(customers, [deviation * 100], "adaptive") == 50
+    assert get_mesh_resolution(customers, [deviation / 100], "adaptive") == 1000
+
+    area = get_geocompetition(customers, read_dataset(config.competitors["test"].path, True), None, False, 1.5, DensityConfig(), 60)
+    assert len(area.latitudes) == len(area.longitudes) == 60
+
+def test_travel_time_cutoff(tmp_path):
+
+    attractiveness = np.array([10.0, 20.0])
+    time = np.array([[5.0, 10.0, 40.0], [50.0, 2.0, 30.0]])
+    entries = np.array([1, 2, 1])
+
+    # Grids beyond the cutoff are left out, bound of the lost probability is not below the exact one
+    pruned = np.where(time > 20, np.nan, time)
+    utility = get_probability(attractiveness[:, np.newaxis], time, 1.5) * entries
+    exact = np.where(time > 20, utility, 0).sum(axis=1) / utility.sum(axis=1)
+    bound = get_lost_probability(attractiveness, pruned, entries, 1.5, 20)
+
+    assert get_huff_probabilities(attractiveness, pruned, entries, 1.5)[:, 2] == approx([0, 0])
+    assert np.all(bound >= exact) and np.all(bound < 1)
+    assert get_lost_probability(attractiveness, time, entries, 1.5, 20) == approx([0, 0])
+
+    customers = read_dataset(config.customers, True)
+    competitors = read_dataset(config.competitors["test"].path, True)
+    assert get_area_key(customers, competitors, 1.5) != get_area_key(customers, competitors, 1.5, max_travel_time=10)
+
+    # Bound of the lost probability is kept with the parameters of the area
+    get_geocompetition(customers, competitors, str(tmp_path), True, 1.5, max_travel_time=240)
+    report = ResultCache(str(tmp_path), 0).read_manifest()[get_area_key(customers, competitors, 1.5, max_travel_time=240)]["report"]
+    assert 0 <= report["travelTimeCutoff"]["lostMean"] <= report["travelTimeCutoff"]["lostMax"] < 1
+
+def test_result_cache(tmp_path, monkeypatch):
+
+    customers = read_dataset(config.customers, True)
+    competitors = read_dataset(config.competitors["test"].path, True)
+
+    # Area is estimated again only if something it depends on changes
+    assert get_area_key(customers, competitors, 1.5) == get_area_key(customers.copy(), competitors.copy(), 1.5)
+    assert get_area_key(customers, competitors, 1.5) != get_area_key(customers, competitors, 2.0)
+    assert get_area_key(customers, competitors, 1.5) != get_area_key(customers, competitors, 1.5, DensityConfig(backend="fft"))
+
+    # Areas estimated on another road graph are not used
+    key = get_area_key(customers, competitors, 1.5)
+    monkeypatch.setattr(geocompetition, "GRAPH_FINGERPRINT", Lazy(lambda: "other"))
+    assert get_area_key(customers, competitors, 1.5) != key
+
+    cache = ResultCache(str(tmp_path), 10)
+    read = lambda path: open(path, "r").read()
+    keys = [get_result_key({"value": value}) for value in range(3)]
+
+    cache.write(keys[0], lambda file: file.write("0" * 4), {"value": 0})
+    cache.write(keys[1], lambda file: file.write("1" * 4), {"value": 1})
+    for i, key in enumerate(keys[:2]):
+        os.utime(cache.get_path(key), (i, i))
+
+    # Reading marks the result as recently used without rewriting the manifest
+    manifest = open(cache.manifest_path).read()
+    with cache.lock(keys[1]):
+        assert cache.read(keys[0], read) == "0" * 4
+    assert open(cache.manifest_path).read() == manifest
+
+    # Least recently used result is removed once the quota is exceeded
+    cache.write(keys[2], lambda file: file.write("2" * 4), {"value": 2})
+    assert keys[0] in cache and keys[1] not in cache and keys[2] in cache
+    assert cache.read(keys[1], read) is None
+    assert set(cache.read_manifest()) == {keys[0], keys[2]}
 
 def test_result(monkeypatch):
     
@@ -199,4 +506,218 @@ def test_result(monkeypatch):
     response = client.post(Urls.Result.value, json=body_mock)
 
     assert response.status_code == 200
-    assert response.json() == json.loads(json.dumps(expect))
\ No newline at end of file
+    assert response.json() == json.loads(json.dumps(expect))
+
+def test_square_nodes():
+
+    centers = get_squares()["center"][:50]
+
+    expected = ox.distance.nearest_nodes(GRAPH.get(), [center.x for center in centers], [center.y for center in centers])
+
+    assert get_square_nodes()[:50].tolist() == list(expected)
+
+def test_distance_matrix(tmp_path, monkeypatch):
+
+    # Searches are split into several chunks
+    monkeypatch.setattr(routing, "DISTANCE_MATRIX_CHUNK_SIZE", 16)
+
+    routing_graph = ROUTING_GRAPH.get()
+    square_nodes = get_square_nodes()[:50].tolist()
+    nodes = routing_graph.get_node_indices(square_nodes)
+    expected = routing_graph.get_distances(nodes)[:, nodes]
+
+    assert routing_graph.get_target_distances(nodes, nodes) == approx(expected)
+
+    dense = DistanceMatrix.from_routing_graph(routing_graph, nodes)
+    sparse = DistanceMatrix.from_routing_graph(routing_graph, nodes, 2000)
+
+    assert dense.get_distances(nodes, nodes) == approx(expected)
+    assert sparse.get_distances(nodes, nodes) == approx(np.where(expected > 2000, np.inf, expected))
+
+    # Stored matrices are memory-mapped and give the same distances
+    save_distance_matrix(sparse, str(tmp_path / "sparse"))
+    loaded = load_distance_matrix(str(tmp_path / "sparse"))
+    assert loaded.limit == 2000 and np.array_equal(loaded.get_distances(nodes, nodes), sparse.get_distances(nodes, nodes))
+
+    distances = get_distances_between_squares(square_nodes[:5], square_nodes, 3000)
+    assert distances == approx(np.where(expected[:5] > 3000, np.nan, expected[:5]), nan_ok=True)
+
+    # Sparse matrix not covering the cutoff gives the same directed distances by routing
+    monkeypatch.setitem(SQUARE_DISTANCES_CACHE, 500, sparse)
+    assert get_distances_between_squares(square_nodes[:5], square_nodes, 3000) == approx(distances, nan_ok=True)
+
+def test_grid_square_indices():
+
+    grid = get_grid()
+    generator = np.random.default_rng(0)
+
+    # Random points around the grid and points on the edges of the squares
+    x = generator.uniform(grid.columns[0] - 0.01, grid.columns[-1] + grid.column_width + 0.01, 3000)
+    y = generator.uniform(grid.rows[0] - 0.01, grid.rows[-1] + grid.height + 0.01, 3000)
+    rows = generator.integers(0, len(grid.rows), 1000)
+    x[:1000] = grid.columns[generator.integers(0, len(grid.columns), 1000)] + grid.widths[rows] * generator.integers(0, 2, 1000)
+    y[1000:2000] = grid.rows[rows]
+
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y))
+    expected = gpd.sjoin(points, get_squares(), how="left", predicate="within")["index_right"].fillna(-1).astype(int)
+
+    assert grid.get_square_indices(x, y).tolist() == expected.tolist()
+
+def test_huff_probabilities():
+
+    attractiveness = np.array([100, 2000])
+    time = np.array([[1, 30, np.nan], [250, 5, 60]])
+    entries = np.array([2, 1, 3])
+
+    probabilities = get_huff_probabilities(attractiveness, time, entries, 1.5)
+
+    for area, competitor_time, competitor_probabilities in zip(attractiveness, time, probabilities):
+        entry_time = [t for t, count in zip(competitor_time, entries) for _ in range(count) if not np.isnan(t)]
+        probabilities_sum = sum(get_probability(area, t, 1.5) for t in entry_time)
+        for t, probability in zip(competitor_time, competitor_probabilities):
+            expected = 0 if np.isnan(t) else get_probability(area, t, 1.5) / probabilities_sum
+            assert probability == approx(expected)
+
+@pytest.mark.parametrize("backend", ["fft", "kdtree"])
+def test_density_backends(backend):
+
+    customers = np.concatenate([read_dataset(config.customers, True), read_dataset("./tests/performance/100-entries.json", True)])
+
+    x = np.linspace(customers[:, 0].min(), customers[:, 0].max(), 50)
+    y = np.linspace(customers[:, 1].min(), customers[:, 1].max(), 60)
+
+    expected = get_density(customers[:, :2].T, customers[:, 2], x, y, "gaussian")
+    density = get_density(customers[:, :2].T, customers[:, 2], x, y, backend, 1e-3)
+
+    assert density.shape == (50, 60)
+    assert np.abs(density - expected).max() <= 1e-3 * expected.max()
+
+def test_customer_density_cached():
+
+    customers = read_dataset(config.customers, True)
+
+    x = np.linspace(customers[:, 0].min(), customers[:, 0].max(), 20)
+    y = np.linspace(customers[:, 1].min(), customers[:, 1].max(), 20)
+
+    CUSTOMER_DENSITY_CACHE.clear()
+    density = get_customer_density(customers, x, y, DensityConfig())
+
+    assert density == approx(get_density(customers[:, :2].T, customers[:, 2], x, y))
+    assert get_customer_density(customers, x, y, DensityConfig()) is density
+
+    # Density saved to the disk is used once the memory cache is empty
+    CUSTOMER_DENSITY_CACHE.clear()
+    assert get_customer_density(customers, x, y, DensityConfig()) == approx(density)
+
+def test_lru_cache():
+
+    cache = LRUCache(3, sizeof=len)
+
+    cache.set("a", "x")
+    cache.set("b", "yy")
+    assert cache.get("a") == "x"
+
+    # "b" is the least recently used, so it is evicted
+    cache.set("c", "z")
+    assert cache.get("b") is None
+    assert cache.get("c") == "z"
+
+    # Values bigger than the cache are not cached
+    cache.set("d", "long")
+    assert cache.get("d") is None
+
+    assert cache.stats() == {"entries": 2, "size": 2, "maxsize": 3, "hits": 2, "misses": 2, "evictions": 1}
+
+def test_metrics():
+
+    response = client.get(Urls.Metrics.value)
+    assert response.status_code == 200
+    assert set(response.json()["datasetCache"].keys()) == {"entries", "size", "maxsize", "hits", "misses", "evictions"}
+    assert set(response.json()["areaCache"].keys()) == {"entries", "size", "maxsize", "hits", "misses", "evictions"}
+
+def test_config_registry(tmp_path):
+
+    path = tmp_path / "init.yaml"
+    path.write_text(open(CONFIG_PATH, encoding="utf-8").read(), encoding="utf-8")
+
+    reloaded = []
+
+    registry = ConfigRegistry()
+    registry.add_listener(lambda path, config: reloaded.append(config))
+
+    assert registry.get(str(path)) == config
+    assert registry.get(str(path)) is registry.get(str(path))
+    assert reloaded == []
+
+    path.write_text(path.read_text(encoding="utf-8").replace("1.5", "2.5"), encoding="utf-8")
+    modified = os.stat(path).st_mtime_ns + 1_000_000_000
+    os.utime(path, ns=(modified, modified))
+
+    assert registry.get(str(path)).competitors["test"].distanceDecay == 2.5
+    assert len(reloaded) == 1
+
+def test_precomputation_counts_cached():
+
+    competitor = config.competitors["test"]
+    get_geocompetition(read_dataset(config.customers), read_dataset(competitor.path), GEOCOMPETITION_TEST_PATH, True, competitor.distanceDecay)
+
+    # Datasets with the cached area are reported as estimated, even though nothing is estimated
+    estimated, failed = [], {}
+    estimate_geocompetition(config, True, estimated.append, on_failed=failed.__setitem__)
+    assert estimated == ["test"] and failed == {}
+
+def test_config_reload_coalesced(monkeypatch):
+
+    started, release, estimated = threading.Event(), threading.Event(), []
+
+    def estimate(config, is_testing):
+        estimated.append(config)
+        started.set()
+        release.wait(5)
+
+    monkeypatch.setattr(main, "estimate_geocompetition", estimate)
+
+    # Reloads that come while the configuration is precomputed do not start another precomputation
+    main.on_config_reload(main.TEST_CONFIG_PATH, config)
+    started.wait(5)
+    main.on_config_reload(main.TEST_CONFIG_PATH, config)
+    main.on_config_reload(main.TEST_CONFIG_PATH, config)
+    release.set()
+
+    main.RELOAD_JOBS.executor.submit(lambda: None).result(5)
+    assert len(estimated) == 1
+
+def test_binary_dataset(tmp_path):
+
+    path = tmp_path / "dataset.json"
+    path.write_text(json.dumps([[49.2, 16.6, 4], [49.1, 16.5, 10.5]]))
+
+    expected = read_dataset(str(path))
+    binary_path = convert_dataset(str(path))
+    dataset = read_dataset(str(path))
+
+    assert binary_path == str(tmp_path / "dataset.npy")
+    assert isinstance(dataset, np.memmap)
+    assert dataset.tolist() == expected.tolist() == [[49.2, 16.6, 4.0], [49.1, 16.5, 10.5]]
+
+    # Newer JSON file takes precedence over the outdated binary one
+    os.utime(binary_path, (0, 0))
+    path.write_text(json.dumps([[49.3, 16.7, 1]]))
+
+    assert read_dataset(str(path)).tolist() == [[49.3, 16.7, 1.0]]
+
+def test_dataset_cache(tmp_path):
+
+    path = tmp_path / "dataset.json"
+    path.write_text(json.dumps([[49.2, 16.6, 4]]))
+
+    dataset = get_dataset(str(path))
+
+    assert get_dataset(str(path)) is dataset
+    assert json.loads(dataset.get_response("customers")) == {"customers": [[49.2, 16.6, 4.0]]}
+
+    path.write_text(json.dumps([[49.3, 16.7, 1]]))
+    modified = os.stat(path).st_mtime_ns + 1_000_000_000
+    os.utime(path, ns=(modified, modified))
+
+    assert get_dataset(str(path)).rows.tolist() == [[49.3, 16.7, 1.0]]
@@ -0,0 +1,322 @@
+"""
+Performance benchmarks of the server.
+
+Run from the server folder (it reads init.yaml), optionally with names of the benchmarks:
+    python tests/performance/benchmark.py routing
+"""
+
+import sys
+import os
+import time
+import pickle
+import random
+import tracemalloc
+
+# Modules of the server are two levels up from this script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import networkx as nx
+
+def measure(function, repeat: int = 1) -> float:
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start_time) / repeat
+
+def benchmark_routing(queries: int = 20):
+    from settings import GRAPH
+    from scripts.routing import RoutingGraph
+
+    GRAPH = GRAPH.get()
+
+    # Memory used by the networkx graph is measured on its unpickled copy
+    tracemalloc.start()
+    graph_copy = pickle.loads(pickle.dumps(GRAPH))
+    networkx_memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del graph_copy
+
+    routing_graph = RoutingGraph.from_graph(GRAPH)
+
+    sources = random.sample(list(GRAPH.nodes), queries)
+    source_indices = routing_graph.get_node_indices(sources)
+
+    networkx_time = measure(lambda: [nx.single_source_dijkstra_path_length(GRAPH, source, weight="length") for source in sources])
+    csr_time = measure(lambda: routing_graph.get_distances(source_indices))
+    build_time = measure(lambda: RoutingGraph.from_graph(GRAPH))
+
+    print(f"Graph: {GRAPH.number_of_nodes()} nodes, {GRAPH.number_of_edges()} edges")
+    print(f"{'':<10}{'memory (MB)':>14}{'query (ms)':>14}")
+    print(f"{'networkx':<10}{networkx_memory / 2**20:>14.2f}{networkx_time / queries * 1000:>14.2f}")
+    print(f"{'csr':<10}{routing_graph.nbytes / 2**20:>14.2f}{csr_time / queries * 1000:>14.2f}")
+    print(f"CSR build time: {build_time:.2f} s")
+
+def huff_loop(attractiveness, time, entries, distance_decay):
+    # Huff model computed one customer entry at a time, the way get_geocompetition used to do it
+    probabilities = []
+    for area, competitor_time in zip(attractiveness, time):
+        entry_time = [t for t, count in zip(competitor_time, entries) for _ in range(count) if t == t]
+        probabilities_sum = sum(area / t ** distance_decay for t in entry_time)
+        probabilities.append([area / t ** distance_decay / probabilities_sum if probabilities_sum else 0.0 for t in entry_time])
+    return probabilities
+
+def benchmark_huff(path: str = "./tests/performance/1000-entries.json"):
+    import numpy as np
+    from utils import read_dataset
+    from scripts.geocompetition import get_huff_probabilities, get_geocompetition
+
+    dataset = read_dataset(path)
+
+    # Synthetic travel times between 1000 competitors and 1000 customer grids with 1 to 30 entries each
+    generator = np.random.default_rng(0)
+    attractiveness = np.array([area for _, _, area in dataset], dtype=float)
+    time = generator.uniform(1, 3000, (len(attractiveness), 1000))
+    entries = generator.integers(1, 30, 1000)
+
+    loop_time = measure(lambda: huff_loop(attractiveness, time, entries, 1.5))
+    vectorized_time = measure(lambda: get_huff_probabilities(attractiveness, time, entries, 1.5), repeat=5)
+
+    expected = np.array(huff_loop(attractiveness, time, entries, 1.5))
+    probabilities = np.repeat(get_huff_probabilities(attractiveness, time, entries, 1.5), entries, axis=1)
+
+    print(f"Huff model, {len(attractiveness)} competitors x {entries.sum()} customer entries")
+    print(f"loop: {loop_time:.3f} s, vectorized: {vectorized_time:.3f} s, max difference: {np.abs(probabilities - expected).max():.2e}")
+
+    geocompetition_time = measure(lambda: get_geocompetition(dataset, dataset, None, False))
+    print(f"get_geocompetition with {path}: {geocompetition_time:.2f} s")
+
+def benchmark_density(path: str = "./database/demo/customers.json", resolution: int = 200):
+    import numpy as np
+    from utils import read_dataset
+    from scripts.density import get_density, DENSITY_BACKENDS
+
+    dataset = read_dataset(path)
+    x = np.linspace(dataset[:, 0].min(), dataset[:, 0].max(), resolution)
+    y = np.linspace(dataset[:, 1].min(), dataset[:, 1].max(), resolution)
+
+    expected = get_density(dataset[:, :2].T, dataset[:, 2], x, y, "gaussian")
+
+    print(f"Density of {len(dataset)} points on {resolution}x{resolution} mesh")
+    print(f"{'backend':<10}{'time (s)':>12}{'max error':>12}")
+    for backend in DENSITY_BACKENDS:
+        density_time = measure(lambda: get_density(dataset[:, :2].T, dataset[:, 2], x, y, backend))
+        error = np.abs(get_density(dataset[:, :2].T, dataset[:, 2], x, y, backend) - expected).max() / expected.max()
+        print(f"{backend:<10}{density_time:>12.3f}{error:>12.1e}")
+
+def benchmark_snapping(meters: int = 500):
+    import osmnx as ox
+    import shapely
+    from settings import GRAPH, ROUTING_GRAPH
+    from utils import get_squares
+
+    centers = get_squares(meters)["center"].to_numpy()
+    x, y = shapely.get_x(centers), shapely.get_y(centers)
+    routing_graph = ROUTING_GRAPH.get()
+    routing_graph.get_nearest_nodes(x[:1], y[:1])
+
+    # Every square snapped on its own, the way get_geocompetition used to do it
+    loop_time = measure(lambda: [ox.distance.nearest_nodes(GRAPH.get(), x_i, y_i) for x_i, y_i in zip(x[:20], y[:20])]) / 20 * len(x)
+    kdtree_time = measure(lambda: routing_graph.get_nearest_nodes(x, y), repeat=5)
+
+    print(f"Snapping {len(x)} grid squares to {len(routing_graph.nodes)} nodes")
+    print(f"per point (estimated): {loop_time:.2f} s, KD-tree: {kdtree_time * 1000:.2f} ms")
+
+def benchmark_squares(sizes: tuple[int, ...] = (500, 200, 100)):
+    from utils import get_squares, SQUARES_CACHE
+
+    print(f"{'meters':<10}{'squares':>10}{'first (s)':>12}{'cached (ms)':>14}")
+    for meters in sizes:
+        SQUARES_CACHE.clear()
+        first_time = measure(lambda: get_squares(meters))
+        cached_time = measure(lambda: get_squares(meters), repeat=100)
+        print(f"{meters:<10}{len(get_squares(meters)):>10}{first_time:>12.3f}{cached_time * 1000:>14.3f}")
+
+def benchmark_assignment(points: int = 1_000_000):
+    import numpy as np
+    import geopandas as gpd
+    from utils import get_grid, get_squares
+
+    grid, squares = get_grid(), get_squares()
+    generator = np.random.default_rng(0)
+    x = generator.uniform(grid.columns[0], grid.columns[-1] + grid.column_width, points)
+    y = generator.uniform(grid.rows[0], grid.rows[-1] + grid.height, points)
+
+    # Spatial join is measured on a sample of the points
+    sample = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x[:100_000], y[:100_000]))
+    sjoin_time = measure(lambda: gpd.sjoin(sample, squares, how="left", predicate="within")) * points / len(sample)
+    grid_time = measure(lambda: grid.get_square_indices(x, y), repeat=3)
+
+    print(f"Assigning {points} points to {len(grid)} squares")
+    print(f"sjoin (estimated): {sjoin_time:.2f} s, grid: {grid_time:.3f} s")
+
+def benchmark_datasets(path: str = "./database/demo/customers.json"):
+    import json
+    import shutil
+    import tempfile
+    from utils import read_dataset, convert_dataset
+
+    # Dataset is converted in a temporary folder, so the binary file does not shadow the JSON one
+    with tempfile.TemporaryDirectory() as folder:
+        json_path = shutil.copy(path, folder)
+        binary_path = convert_dataset(json_path)
+
+        def read_json():
+            with open(json_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+
+        tracemalloc.start()
+        dataset = read_json()
+        json_memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        json_time = measure(read_json, repeat=5)
+        binary_time = measure(lambda: read_dataset(binary_path), repeat=100)
+
+        print(f"Dataset {path} with {len(dataset)} rows")
+        print(f"json: {json_time * 1000:.2f} ms ({json_memory / 2**20:.2f} MB), npy (memory-mapped): {binary_time * 1000:.3f} ms ({os.path.getsize(binary_path) / 2**20:.2f} MB on disk)")
+
+def benchmark_mesh(
+    customers_path: str = "./database/demo/customers.json",
+    competitors_path: str = "./database/demo/POTR---ryby.json",
+    resolutions: tuple = (50, 100, 200, 400, "adaptive"),
+    reference_resolution: int = 800
+):
+    import tempfile
+    import numpy as np
+    from scipy.interpolate import RegularGridInterpolator
+    from settings import DensityConfig
+    from utils import read_dataset
+    import scripts.geocompetition as geocompetition
+
+    customers, competitors = read_dataset(customers_path), read_dataset(competitors_path)
+    density = DensityConfig(backend="fft")
+
+    # Density of the customers is not cached between the resolutions, so it is a part of the cost
+    with tempfile.TemporaryDirectory() as folder:
+        geocompetition.DENSITY_CACHE_PATH = folder
+
+        def estimate(resolution):
+            geocompetition.CUSTOMER_DENSITY_CACHE.clear()
+            return geocompetition.estimate_area(customers, competitors, 1.5, density, resolution)
+
+        reference = estimate(reference_resolution)
+        reference_rows = reference.get_rows()
+        reference_max = reference.density.max()
+
+        print(f"Area of {competitors_path}, error relative to the maximum of {reference_resolution}x{reference_resolution} mesh")
+        print(f"{'resolution':<12}{'points':>10}{'time (s)':>12}{'max error':>12}{'mean error':>12}")
+        for resolution in resolutions:
+            estimate(resolution)
+            surface_time = measure(lambda: estimate(resolution))
+            surface = estimate(resolution)
+
+            # Surface is interpolated at the points of the reference mesh (within the same bounds)
+            interpolator = RegularGridInterpolator((surface.longitudes, surface.latitudes), surface.density)
+            error = np.abs(interpolator(reference_rows[:, [1, 0]]) - reference_rows[:, 2]) / reference_max
+
+            label = f"{resolution} ({len(surface.latitudes)})" if resolution == "adaptive" else str(resolution)
+            print(f"{label:<12}{len(surface):>10}{surface_time:>12.3f}{error.max():>12.1e}{error.mean():>12.1e}")
+
+def benchmark_cutoff(
+    customers_path: str = "./database/demo/customers.json",
+    competitors_path: str = "./database/demo/POTR---lahůdky.json",
+    max_travel_times: tuple = (None, 60, 30, 20, 10)
+):
+    import numpy as np
+    from settings import ROUTING_GRAPH
+    from utils import read_dataset, get_grid
+    from scripts.geocompetition import (
+        get_square_nodes, get_cutoff_distance, get_probability, get_lost_probability, GRID_SIZE, AVERAGE_WALKING_SPEED
+    )
+
+    customers, competitors = read_dataset(customers_path), read_dataset(competitors_path)
+    grid, square_nodes, routing_graph = get_grid(GRID_SIZE), get_square_nodes(GRID_SIZE), ROUTING_GRAPH.get()
+
+    # Competitors and customer grids the same way estimate_area_tiles has them
+    customer_squares = grid.get_square_indices(customers[:, 1], customers[:, 0])
+    competitor_squares = grid.get_square_indices(competitors[:, 1], competitors[:, 0])
+    competitors = competitors[competitor_squares >= 0]
+    customer_grids, entries = np.unique(customer_squares[customer_squares >= 0], return_counts=True)
+    sources, competitor_sources = np.unique(routing_graph.get_node_indices(square_nodes[competitor_squares[competitor_squares >= 0]]), return_inverse=True)
+    targets = routing_graph.get_node_indices(square_nodes[customer_grids])
+
+    def get_time(cutoff):
+        distances = routing_graph.get_distances(sources, cutoff)[:, targets][competitor_sources]
+        time = np.where(np.isinf(distances), np.nan, distances) / AVERAGE_WALKING_SPEED
+        time[time == 0] = 1
+        return time
+
+    full_time = get_time(None)
+    full_utility = np.nan_to_num(get_probability(competitors[:, 2:3], full_time, 1.5), nan=0.0) * entries
+
+    print(f"{len(sources)} competitor nodes x {len(targets)} customer grids of {competitors_path}, distance decay 1.5")
+    print(f"{'max time':<10}{'routing (ms)':>14}{'pairs':>8}{'lost mean':>12}{'lost max':>10}{'bound mean':>12}{'bound max':>11}")
+    for max_travel_time in max_travel_times:
+        cutoff = get_cutoff_distance(max_travel_time)
+        routing_time = measure(lambda: routing_graph.get_distances(sources, cutoff), repeat=3)
+        time = get_time(cutoff)
+
+        # Exact share of the utility of the competitors beyond the cutoff and its upper bound
+        lost = np.where(np.isnan(time), full_utility, 0).sum(axis=1) / full_utility.sum(axis=1)
+        bound = get_lost_probability(competitors[:, 2], time, entries, 1.5, cutoff / AVERAGE_WALKING_SPEED) if cutoff else np.zeros(1)
+
+        label = "none" if max_travel_time is None else f"{max_travel_time} min"
+        print(f"{label:<10}{routing_time * 1000:>14.1f}{(~np.isnan(time)).mean():>8.1%}{lost.mean():>12.2%}{lost.max():>10.2%}{bound.mean():>12.2%}{bound.max():>11.2%}")
+
+def benchmark_matrix(
+    customers_path: str = "./database/demo/customers.json",
+    competitors_path: str = "./database/demo/POTR---lahůdky.json",
+    limits: tuple = (None, 5000, 2000)
+):
+    import numpy as np
+    from settings import ROUTING_GRAPH
+    from utils import read_dataset, get_grid
+    from scripts.routing import DistanceMatrix
+    from scripts.geocompetition import get_square_nodes, GRID_SIZE
+
+    customers, competitors = read_dataset(customers_path), read_dataset(competitors_path)
+    grid, square_nodes, routing_graph = get_grid(GRID_SIZE), get_square_nodes(GRID_SIZE), ROUTING_GRAPH.get()
+
+    # Competitor nodes and customer grids the same way estimate_area_tiles has them
+    customer_squares = grid.get_square_indices(customers[:, 1], customers[:, 0])
+    competitor_squares = grid.get_square_indices(competitors[:, 1], competitors[:, 0])
+    sources = np.unique(routing_graph.get_node_indices(square_nodes[competitor_squares[competitor_squares >= 0]]))
+    targets = routing_graph.get_node_indices(square_nodes[np.unique(customer_squares[customer_squares >= 0])])
+    nodes = routing_graph.get_node_indices(square_nodes)
+
+    routing_time = measure(lambda: routing_graph.get_distances(sources)[:, targets], repeat=3)
+    print(f"{len(sources)} competitor nodes x {len(targets)} customer grids of {competitors_path}, {len(np.unique(nodes))} square nodes")
+    print(f"routing per dataset: {routing_time * 1000:.1f} ms")
+    print(f"{'limit (m)':<10}{'build (s)':>10}{'size (MB)':>11}{'lookup (ms)':>13}")
+    for limit in limits:
+        matrix = None
+        def build():
+            nonlocal matrix
+            matrix = DistanceMatrix.from_routing_graph(routing_graph, nodes, limit)
+
+        build_time = measure(build)
+        lookup_time = measure(lambda: matrix.get_distances(sources, targets), repeat=3)
+        print(f"{'none' if limit is None else limit:<10}{build_time:>10.2f}{matrix.nbytes / 2**20:>11.2f}{lookup_time * 1000:>13.2f}")
+
+BENCHMARKS = {
+    "routing": benchmark_routing,
+    "huff": benchmark_huff,
+    "density": benchmark_density,
+    "snapping": benchmark_snapping,
+    "squares": benchmark_squares,
+    "assignment": benchmark_assignment,
+    "datasets": benchmark_datasets,
+    "mesh": benchmark_mesh,
+    "cutoff": benchmark_cutoff,
+    "matrix": benchmark_matrix,
+}
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        print(f"--- {name} ---")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
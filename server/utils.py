@@ -8,18 +8,151 @@ from typing import Optional
 import math
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import Polygon, Point
-import osmnx as ox
+import numpy as np
+import shapely
 import networkx as nx
 import json
 import os
+import sys
+import gzip
+import hashlib
+import threading
+import uuid
+import time
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from typing import Any, Callable, Hashable
 
 from settings import (
-    GRAPH
+    GRAPH_PATH,
+    ROUTING_GRAPH
 )
 
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional, without it responses are compressed only by gzip
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    # File locks are not available on Windows, only threads of one process are synchronized there
+    fcntl = None
+
 CACHE_COORDINATES = {}
 
+# Generated grids and their squares, by the graph of the area and the size of the squares
+GRIDS_CACHE: dict[tuple[str, float], "Grid"] = {}
+SQUARES_CACHE: dict[tuple[str, float], gpd.GeoDataFrame] = {}
+SQUARES_LOCK = threading.Lock()
+
+class LRUCache:
+    """
+    Thread-safe cache that evicts the least recently used entries once it is full.
+
+    Size of each entry is given by the sizeof function (1 by default, so the 
+    cache is bounded by the number of entries). Hits, misses and evictions 
+    are counted, so the efficiency of the cache can be monitored.
+
+    Example:
+        >>> cache = LRUCache(2)
+        >>> cache.set("a", 1); cache.set("b", 2); cache.set("c", 3)
+        >>> cache.get("a"), cache.get("c")
+        (None, 3)
+        >>> cache.stats()
+        {'entries': 2, 'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 1, 'evictions': 1}
+    """
+
+    def __init__(self, maxsize: int, sizeof: Callable[[Any], int] | None = None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._sizeof = sizeof or (lambda value: 1)
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        # Checking the key neither counts as a hit or miss nor makes the entry recently used
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get the value of the key and mark it as the most recently used.
+
+        Args:
+            key (Hashable): The key.
+            default (Any, optional): Returned if the key is not cached. Defaults to None.
+
+        Returns:
+            Any: The cached value or the default.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Cache the value of the key, evicting the least recently used entries if the cache is full.
+
+        Values bigger than the whole cache are not cached.
+
+        Args:
+            key (Hashable): The key.
+            value (Any): The value.
+        """
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            if size > self.maxsize:
+                return
+
+            self._entries[key] = (value, size)
+            self._size += size
+
+            while self._size > self.maxsize:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Remove all the entries, the counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> dict[str, int]:
+        """
+        Get the counters of the cache.
+
+        Returns:
+            dict[str, int]: Number of entries, their total size, maximum size, 
+                hits, misses and evictions.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size": self._size,
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
 def get_coordinates(place: str) -> Optional[tuple[float, float]]:
     """
     Get the coordinates (latitude and longitude) of a place.
@@ -54,6 +187,197 @@ def get_coordinates(place: str) -> Optional[tuple[float, float]]:
         return None
     
 
+class Grid:
+    """
+    Grid of squares covering the area of the graph.
+
+    Squares are ordered by columns (from west to east) and by rows within
+    the columns (from south to north), so the square in column c and row r 
+    has index c * len(rows) + r. Width of the squares in degrees depends 
+    on the latitude of their row, columns are shifted by the width of the 
+    squares in the last row.
+
+    Attributes:
+        columns (np.ndarray): West edge of every column.
+        rows (np.ndarray): South edge of every row.
+        widths (np.ndarray): Width of the squares in every row (degrees of longitude).
+        column_width (float): Distance between the columns (degrees of longitude).
+        height (float): Height of the squares (degrees of latitude).
+        meters (float): The size of the squares in meters.
+
+    Example:
+        >>> grid = Grid.from_bounds(16.5, 49.1, 16.7, 49.3, 500)
+        >>> grid.get_square_indices(np.array([16.6, 17.0]), np.array([49.2, 49.2]))
+        array([652,  -1])
+    """
+
+    def __init__(self, columns: np.ndarray, rows: np.ndarray, widths: np.ndarray, column_width: float, height: float, meters: float):
+        self.columns = columns
+        self.rows = rows
+        self.widths = widths
+        self.column_width = column_width
+        self.height = height
+        self.meters = meters
+
+    @classmethod
+    def from_bounds(cls, minx: float, miny: float, maxx: float, maxy: float, meters: float) -> "Grid":
+        """
+        Divide the bounding box into squares of the given size.
+
+        Args:
+            minx (float): West edge of the bounding box.
+            miny (float): South edge of the bounding box.
+            maxx (float): East edge of the bounding box.
+            maxy (float): North edge of the bounding box.
+            meters (float): The size of each square in meters.
+
+        Returns:
+            Grid: The grid covering the bounding box.
+        """
+        # Approximate scaling factor: 1 degree = 111 kilometers
+        height = meters / 111000
+
+        # Bottom of every row, degrees are added one after another (accumulate is not pairwise), so rounding is the same as when adding in a loop
+        rows = np.add.accumulate(np.concatenate([[miny], np.full(int((maxy - miny) / height) + 2, height)]))
+        rows = rows[rows < maxy]
+
+        # Scaling factor for longitude varies with latitude, so every row has its own width of the squares
+        widths = np.fromiter((meters / (math.cos(math.radians(latitude)) * 111000) for latitude in rows), dtype=float, count=len(rows))
+        column_width = widths[-1] if len(rows) else meters / (math.cos(math.radians(miny)) * 111000)
+
+        columns = np.add.accumulate(np.concatenate([[minx], np.full(int((maxx - minx) / column_width) + 2, column_width)]))
+        columns = columns[columns < maxx]
+
+        return cls(columns, rows, widths, column_width, height, meters)
+
+    def __len__(self) -> int:
+        return len(self.columns) * len(self.rows)
+
+    def get_description(self) -> dict[str, float | int | None]:
+        """
+        Describe the grid by its origin, spacing and size.
+
+        The square in column c and row r spans latitudes from south + r * height
+        to south + (r + 1) * height and longitudes from west + c * columnWidth, its
+        width is meters / (cos(latitude of the square's south edge) * 111000) degrees.
+        The description (unlike the polygons) does not grow with the area.
+
+        Returns:
+            dict[str, float | int | None]: West and south edge of the grid, distance between 
+                the columns, height of the squares, number of columns and rows and the 
+                size of the squares in meters.
+
+        Example:
+            >>> Grid.from_bounds(16.5, 49.1, 16.7, 49.3, 500).get_description()
+            {'west': 16.5, 'south': 49.1, 'columnWidth': 0.0069..., 'height': 0.0045..., 'columns': 29, 'rows': 45, 'meters': 500}
+        """
+        return {
+            "west": float(self.columns[0]) if len(self.columns) else None,
+            "south": float(self.rows[0]) if len(self.rows) else None,
+            "columnWidth": float(self.column_width),
+            "height": float(self.height),
+            "columns": len(self.columns),
+            "rows": len(self.rows),
+            "meters": self.meters
+        }
+
+    def get_squares(self) -> gpd.GeoDataFrame:
+        """
+        Create polygons and centers of all the squares.
+
+        Returns:
+            gpd.GeoDataFrame: The squares with "center" and "geometry" columns.
+        """
+        # Corners of every square, column by column
+        x1 = np.repeat(self.columns, len(self.rows))
+        y1 = np.tile(self.rows, len(self.columns))
+        x2 = x1 + np.tile(self.widths, len(self.columns))
+        y2 = y1 + self.height
+
+        rings = np.stack([np.column_stack(corner) for corner in ((x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1))], axis=1)
+
+        return gpd.GeoDataFrame({
+            "center": shapely.points(x2 - (x2 - x1) / 2, y2 - (y2 - y1) / 2),
+            "geometry": shapely.polygons(rings)
+        })
+
+    @staticmethod
+    def get_positions(values: np.ndarray, starts: np.ndarray, step: float) -> np.ndarray:
+        """
+        Get the index of the last start that is not greater than each of the values (clipped to the starts).
+
+        The index is guessed from the step and corrected by one, since the guess 
+        can be off due to rounding of the accumulated starts.
+        """
+        values = np.where(np.isfinite(values), values, starts[0] - step)
+        positions = np.clip(np.floor((values - starts[0]) / step), 0, len(starts) - 1).astype(int)
+        positions -= (positions > 0) & (values < starts[positions])
+        positions += (positions < len(starts) - 1) & (values >= starts[np.minimum(positions + 1, len(starts) - 1)])
+        return positions
+
+    def get_square_indices(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Get the square every point lies within.
+
+        Points are assigned to the squares the same way as by the "within" spatial 
+        join with the polygons of the squares: a point has to be in the interior of 
+        the square, so points on the edges (and in the gaps between the narrower 
+        squares of the southern rows) do not belong to any square. If the squares 
+        overlap (only south of the equator, where the squares of the last row are 
+        the narrowest), the point gets the square with the lower index.
+
+        Args:
+            x (np.ndarray): Longitudes of the points.
+            y (np.ndarray): Latitudes of the points.
+
+        Returns:
+            np.ndarray: Index of the square of every point, -1 if it does not lie within any square.
+        """
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
+        if len(self) == 0:
+            return np.full(len(x), -1)
+
+        rows = self.get_positions(y, self.rows, self.height)
+        columns = self.get_positions(x, self.columns, self.column_width)
+        widths = self.widths[rows]
+
+        within_row = (y > self.rows[rows]) & (y < self.rows[rows] + self.height)
+        within_column = (x > self.columns[columns]) & (x < self.columns[columns] + widths)
+
+        # Overlapping square of the previous column goes first
+        previous = np.maximum(columns - 1, 0)
+        within_previous = (columns > 0) & (x < self.columns[previous] + widths)
+        columns = np.where(within_previous, previous, columns)
+
+        return np.where(within_row & (within_previous | within_column), columns * len(self.rows) + rows, -1)
+
+def get_grid(meters=500) -> Grid:
+    """
+    Get the grid of squares covering the area of the graph.
+
+    The grid is generated only once for each area and size of the squares.
+
+    Args:
+        meters (float, optional): The size of each square in meters. 
+            Defaults to 500.
+
+    Returns:
+        Grid: The grid covering the bounding box of the nodes of the graph.
+
+    Notes:
+        This function assumes the existence of a global variable ROUTING_GRAPH, 
+        which lazily loads coordinates of the nodes of the graph.
+    """
+    key = (GRAPH_PATH.get(), meters)
+
+    with SQUARES_LOCK:
+        if key not in GRIDS_CACHE:
+            routing_graph = ROUTING_GRAPH.get()
+            GRIDS_CACHE[key] = Grid.from_bounds(routing_graph.x.min(), routing_graph.y.min(), routing_graph.x.max(), routing_graph.y.max(), meters)
+
+        return GRIDS_CACHE[key]
+
 def get_squares(meters=500) -> gpd.GeoDataFrame:
     """
     Generate square polygons covering the area of the graph.
@@ -61,7 +385,10 @@ def get_squares(meters=500) -> gpd.GeoDataFrame:
     This function generates square polygons covering the area of the graph. 
     Each square has a specified size in meters and is defined by its center 
     point. The function divides the bounding box of the graph into squares 
-    and creates polygons for each square.
+    and creates polygons for each square (see Grid for their order). 
+    
+    The squares are generated only once for each area and size of the squares, 
+    so they must not be modified.
 
     Args:
         meters (float, optional): The size of each square in meters. 
@@ -71,10 +398,6 @@ def get_squares(meters=500) -> gpd.GeoDataFrame:
         gpd.GeoDataFrame: A GeoDataFrame containing square polygons 
             covering the area of the graph.
 
-    Notes:
-        This function assumes the existence of a global variable GRAPH, 
-        which represents the graph data.
-
     Example:
         >>> get_squares(1000)
         <GeoDataFrame>
@@ -83,50 +406,14 @@ def get_squares(meters=500) -> gpd.GeoDataFrame:
         1   POLYGON ((<coordinates>))  POINT (<center coordinates>)
         ...
     """
-    def add_meters_to_latitude(latitude: float, meters: float) -> float:
-        # Approximate scaling factor: 1 degree = 111 kilometers
-        # meters = meters / 111000 degrees
-        delta_lat = meters / 111000
-        new_latitude = latitude + delta_lat
-        return new_latitude
-
-    def add_meters_to_longitude(longitude: float, latitude: float, meters: float) -> float:
-        # Approximate scaling factor for longitude at equator: 1 degree = 111 kilometers
-        # Scaling factor varies with latitude
-        # Calculate the scaling factor for longitude at the given latitude
-        scaling_factor = math.cos(math.radians(latitude))
-
-        # meters meters = meters / (scaling_factor * 111000) degrees
-        delta_lon = meters / (scaling_factor * 111000)
-        new_longitude = longitude + delta_lon
-        return new_longitude
-    
-    gdf_nodes, gdf_edges = ox.graph_to_gdfs(GRAPH)
-
-    # Get the bounding box coordinates
-    minx, miny, maxx, maxy = gdf_nodes.geometry.total_bounds # type: ignore
-
-    geometry: list[Polygon] = []
-    center: list[Point] = []
-
-    x1 = minx
-    while x1 < maxx:
-
-        y1 = miny
-        x2 = add_meters_to_longitude(x1, miny, meters)
-
-        while y1 < maxy:
+    grid = get_grid(meters)
+    key = (GRAPH_PATH.get(), meters)
 
-            x2 = add_meters_to_longitude(x1, y1, meters)
-            y2 = add_meters_to_latitude(y1, meters)
+    with SQUARES_LOCK:
+        if key not in SQUARES_CACHE:
+            SQUARES_CACHE[key] = grid.get_squares()
 
-            center.append(Point(x2 - (x2 - x1) / 2, y2 - (y2 - y1) / 2))
-            geometry.append(Polygon([(x1, y1), (x2, y1), (x2, y2), (x1, y2)]))
-
-            y1 = y2
-        x1 = x2
-
-    return gpd.GeoDataFrame({"center": center, "geometry": geometry})
+        return SQUARES_CACHE[key]
 
 def get_squares_list() -> list[list[float]]:
     """
@@ -151,7 +438,8 @@ def get_squares_list() -> list[list[float]]:
             ...
         ]
     """
-    return [list(geometry.exterior.coords) for geometry in get_squares()["geometry"]] # type: ignore
+    # Every square has 5 exterior coordinates (the first one is repeated to close the ring)
+    return shapely.get_coordinates(get_squares()["geometry"].values).reshape(-1, 5, 2).tolist()
 
 def read_json_file(path_to_file: str, is_relative: bool = False) -> dict | list:
     """
@@ -187,10 +475,416 @@ def read_json_file(path_to_file: str, is_relative: bool = False) -> dict | list:
     except FileNotFoundError as e:
         exit(str(e))
 
-def read_dataset(path_to_file: str, is_relative: bool = False) -> list[tuple[float, float, float]]:
+def get_binary_path(path_to_file: str) -> str:
+    """
+    Get the path of the binary (.npy) version of the dataset.
+
+    Example:
+        >>> get_binary_path("./database/demo/customers.json")
+        './database/demo/customers.npy'
+    """
+    return f"{os.path.splitext(path_to_file)[0]}.npy"
+
+def convert_dataset(path_to_file: str, is_relative: bool = False) -> str:
+    """
+    Convert the JSON dataset to the binary format.
+
+    Rows of the dataset are stored as float64 array of shape (N, 3) in .npy file
+    next to the JSON file, so the dataset can be memory-mapped by read_dataset 
+    instead of parsing the JSON. The file is written atomically, so a partially 
+    written dataset is never read.
+
+    Args:
+        path_to_file (str): The path to the JSON dataset.
+        is_relative (bool, optional): Whether the provided path is relative to the 
+            current working directory. Defaults to False.
+
+    Returns:
+        str: The path to the binary dataset.
+
+    Example:
+        >>> convert_dataset("./database/demo/customers.json")
+        './database/demo/customers.npy'
+    """
+    path = os.path.join(os.getcwd(), path_to_file) if is_relative else path_to_file
+    binary_path = get_binary_path(path)
+
+    dataset = np.asarray(read_json_file(path), dtype=np.float64).reshape(-1, 3)
+
+    write_atomically(binary_path, lambda file: np.save(file, dataset))
+
+    return binary_path
+
+def read_dataset(path_to_file: str, is_relative: bool = False) -> np.ndarray:
+    """
+    Read the dataset of (latitude, longitude, value) rows.
+
+    If the binary version of the dataset exists (see convert_dataset) and it is not
+    older than the JSON file, it is memory-mapped, so the rows are read from the 
+    disk only when they are used. Otherwise the JSON file is parsed.
+
+    Args:
+        path_to_file (str): The path to the dataset (JSON or .npy file).
+        is_relative (bool, optional): Whether the provided path is relative to the 
+            current working directory. Defaults to False.
+
+    Returns:
+        np.ndarray: Read-only float64 array of shape (N, 3).
+
+    Example:
+        >>> read_dataset("./database/demo/customers.json")[:2]
+        memmap([[49.17789499, 16.58125533,  4.        ],
+                [49.1647249 , 16.57884696,  5.        ]])
+    """
+    path = os.path.join(os.getcwd(), path_to_file) if is_relative else path_to_file
+    binary_path = get_binary_path(path)
+
+    if os.path.exists(binary_path) and (not os.path.exists(path) or os.path.getmtime(binary_path) >= os.path.getmtime(path)):
+        return np.load(binary_path, mmap_mode="r")
+
+    dataset = np.asarray(read_json_file(path), dtype=np.float64).reshape(-1, 3)
+    dataset.flags.writeable = False
+
+    return dataset
+
+class Dataset:
+    """
+    Dataset read from the disk together with its JSON serialization.
+
+    Attributes:
+        rows (np.ndarray): Rows of the dataset (see read_dataset).
+        json (bytes): The rows serialized to JSON, so they can be sent without encoding them again.
+        signature (tuple): Modification times of the files the dataset was read from.
+    """
+
+    def __init__(self, rows: np.ndarray, signature: tuple):
+        self.rows = rows
+        self.json = json.dumps(rows.tolist(), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        self.signature = signature
+
+    @property
+    def nbytes(self) -> int:
+        return self.rows.nbytes + len(self.json)
+
+    def get_response(self, key: str) -> bytes:
+        """
+        Get the JSON response with the rows under the given key.
+
+        Example:
+            >>> get_dataset("./tests/competitors.json").get_response("competitors")
+            b'{"competitors":[[49.20756769400003,16.48734365000007,100.0],...]}'
+        """
+        return b'{"' + key.encode("utf-8") + b'":' + self.json + b'}'
+
+# Maximum size of the cached datasets (rows and their JSON) in bytes
+DATASET_CACHE_SIZE = 512 * 2**20
+
+# Datasets read by the server, by the path to the dataset
+DATASETS_CACHE = LRUCache(DATASET_CACHE_SIZE, sizeof=lambda dataset: dataset.nbytes)
+
+def get_dataset_signature(path_to_file: str) -> tuple:
+    """
+    Get modification times of the dataset and of its binary version (None if the file does not exist).
+    """
+    return tuple(os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in (path_to_file, get_binary_path(path_to_file)))
+
+def get_dataset(path_to_file: str, is_relative: bool = False) -> Dataset:
+    """
+    Get the dataset, reading it only if it is not cached or it changed on the disk.
+
+    Datasets are cached by the whole process, the least recently used ones are 
+    evicted once the cache exceeds DATASET_CACHE_SIZE. Cached dataset is read 
+    again once its file (or its binary version) is modified.
+
+    Args:
+        path_to_file (str): The path to the dataset (JSON or .npy file).
+        is_relative (bool, optional): Whether the provided path is relative to the 
+            current working directory. Defaults to False.
+
+    Returns:
+        Dataset: The dataset with its JSON serialization.
+
+    Example:
+        >>> get_dataset("./database/demo/customers.json").rows.shape
+        (29020, 3)
+    """
+    path = os.path.join(os.getcwd(), path_to_file) if is_relative else path_to_file
+    signature = get_dataset_signature(path)
+
+    dataset: Dataset | None = DATASETS_CACHE.get(path)
+
+    if dataset is None or dataset.signature != signature:
+        dataset = Dataset(read_dataset(path), signature)
+        DATASETS_CACHE.set(path, dataset)
+
+    return dataset
+
+# Compression levels of the encoded responses, higher ones take seconds for large areas and save little
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+class EncodedResponse:
+    """
+    Body of a response encoded in advance together with its compressed versions.
+
+    The body is compressed only once, so the same response can be sent many 
+    times without encoding or compressing it again.
+
+    Attributes:
+        content (bytes): The uncompressed body.
+        media_type (str): Media type of the body.
+        etag (str): Entity tag of the body (quoted hash of the content).
+        encodings (dict[str, bytes]): Compressed body by the content encoding ("gzip", and "br" if brotli is installed).
+
+    Example:
+        >>> response = EncodedResponse(b'{"area":[]}')
+        >>> response.get_content("gzip, deflate, br")[0]
+        'gzip'
+    """
+
+    def __init__(self, content: bytes, media_type: str = "application/json"):
+        self.content = content
+        self.media_type = media_type
+        self.etag = f'"{hashlib.sha1(content).hexdigest()}"'
+        self.encodings = {"gzip": gzip.compress(content, compresslevel=GZIP_LEVEL, mtime=0)}
+
+        if brotli is not None:
+            self.encodings["br"] = brotli.compress(content, quality=BROTLI_QUALITY)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.content) + sum(len(content) for content in self.encodings.values())
+
+    def get_content(self, accept_encoding: str) -> tuple[str | None, bytes]:
+        """
+        Get the smallest version of the body the client accepts.
+
+        Args:
+            accept_encoding (str): Accept-Encoding header of the request.
+
+        Returns:
+            tuple[str | None, bytes]: Content encoding (None if not compressed) and the body.
+        """
+        accepted = set()
+        for value in accept_encoding.split(","):
+            encoding, *parameters = [part.strip() for part in value.split(";")]
+            if not any(parameter.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for parameter in parameters):
+                accepted.add(encoding.lower())
+
+        for encoding in ("br", "gzip"):
+            if encoding in self.encodings and (encoding in accepted or "*" in accepted):
+                return encoding, self.encodings[encoding]
+
+        return None, self.content
+
+    def matches(self, if_none_match: str | None) -> bool:
+        """
+        Whether the client already has this body (If-None-Match header of the request matches the entity tag).
+        """
+        if not if_none_match:
+            return False
+
+        etags = [etag.strip().removeprefix("W/") for etag in if_none_match.split(",")]
+        return "*" in etags or self.etag in etags
+
+class Job:
+    """
+    Work submitted to the JobManager.
+
+    Attributes:
+        id (str): Unique id of the job.
+        key (Hashable): Key of the work, jobs with the same key do the same work.
+        status (str): "pending", "running", "done" or "failed".
+        details (dict[str, Any]): Details of the job reported with its status.
+        error (str | None): Error message if the job failed.
+    """
+
+    def __init__(self, key: Hashable, details: dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = "pending"
+        self.details = details
+        self.error: str | None = None
+        self.submitted = time.time()
+        self.finished: float | None = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "job": self.id,
+            "status": self.status,
+            **self.details,
+            "error": self.error,
+            "duration": (self.finished or time.time()) - self.submitted
+        }
+
+class JobManager:
+    """
+    Runs the work in background threads, so the requests do not wait for it.
+
+    Work with the same key that is already pending or running is not submitted 
+    again, the job that does it is returned instead. Finished jobs are kept 
+    (up to the history size), so their status can be checked later.
+
+    Example:
+        >>> jobs = JobManager()
+        >>> job = jobs.submit(("dataset", 1.5), lambda: estimate(), dataset="dataset")
+        >>> jobs.submit(("dataset", 1.5), lambda: estimate()) is job
+        True
+    """
+
+    def __init__(self, workers: int = 1, history: int = 1000):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.history = history
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.active: dict[Hashable, Job] = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key: Hashable, function: Callable[[], Any], **details: Any) -> Job:
+        """
+        Submit the work, unless the same work is already pending or running.
+
+        Args:
+            key (Hashable): Key of the work.
+            function (Callable[[], Any]): The work.
+            details (Any): Details of the job reported with its status.
+
+        Returns:
+            Job: The job doing the work.
+        """
+        with self.lock:
+            if key in self.active:
+                return self.active[key]
+
+            job = Job(key, details)
+            self.active[key] = job
+            self.jobs[job.id] = job
+
+            # Only the finished jobs are forgotten
+            while len(self.jobs) > self.history:
+                oldest = next((job_id for job_id, old_job in self.jobs.items() if old_job.is_finished), None)
+                if oldest is None:
+                    break
+                del self.jobs[oldest]
+
+        self.executor.submit(self.run, job, function)
+        return job
+
+    def run(self, job: Job, function: Callable[[], Any]) -> None:
+        job.status = "running"
+        try:
+            function()
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                self.active.pop(job.key, None)
+
+    def get(self, job_id: str) -> Job | None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+def write_atomically(path: str, write: Callable[[Any], None], mode: str = "wb") -> None:
+    """
+    Write the file through a temporary file, which is renamed once it is written.
+
+    Readers see either the previous version of the file or the whole new one,
+    never a partially written file.
+
+    Args:
+        path (str): The path to the file.
+        write (Callable[[Any], None]): Function writing the content to the given file object.
+        mode (str, optional): Mode the temporary file is opened in. Defaults to "wb".
+
+    Example:
+        >>> write_atomically("./data/area.json", lambda file: json.dump(area, file), "w")
+    """
+    folder = os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+
+    descriptor, temp_path = tempfile.mkstemp(dir=folder, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, mode) as file:
+            write(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Hold an exclusive lock of the file (shared by all the processes) while in the context.
+
+    The lock is taken on a separate ".lock" file next to the given path.
+
+    Example:
+        >>> with file_lock("./data/area.json"):
+        ...     area = read_from_cache("./data/area.json") or estimate()
+    """
+    folder = os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+
+    with open(f"{path}.lock", "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls doing the same work.
+
+    The first caller with a key runs the function, callers with the same key 
+    that come while it is running wait for its result (or exception) instead 
+    of running the function again.
+
+    Example:
+        >>> calls = SingleFlight()
+        >>> calls.do(("dataset", 1.5), lambda: estimate())
+    """
+
+    def __init__(self):
+        self.calls: dict[Hashable, Future] = {}
+        self.lock = threading.Lock()
+
+    def do(self, key: Hashable, function: Callable[[], Any]) -> Any:
+        with self.lock:
+            future = self.calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self.calls[key] = Future()
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = function()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
 
-    dataset = read_json_file(path_to_file, is_relative)
+if __name__ == "__main__":
+    # Convert the given JSON datasets (or all the datasets of the configuration) to the binary format
+    from settings import CONFIG
 
-    # TODO validation
+    paths = sys.argv[1:] or [CONFIG.get().customers] + [competitor.path for competitor in CONFIG.get().competitors.values()]
 
-    return dataset # type: ignore
\ No newline at end of file
+    for path in paths:
+        print(f"{path} -> {convert_dataset(path)}")